@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+import gzip
+import hashlib
+import json
+import tempfile
+from threading import Lock
+
+import clients
+from pool import run_in_pool
+
+# bytes read at a time when hashing and compressing spooled files
+COPY_CHUNK_BYTES = 1024 * 1024
+
+
+class NdjsonArchive(object):
+    """
+    Appends records as JSON lines to a temporary file, so that results too large for memory can be archived
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+
+    def __call__(self, *record):
+        self.file.write((json.dumps(record) + '\n').encode('utf-8'))
+
+    def close(self):
+        self.file.close()
+
+
+class _Shard(object):
+    """
+    gzip compressed NDJSON object spooled to a temporary file; every payload is a gzip member of its own, so that a
+    byte range of the object decompresses to one payload while the whole object decompresses to every payload
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = tempfile.TemporaryFile()
+        self.lock = Lock()
+        # no more payloads once the shard is being uploaded
+        self.sealed = False
+
+    def write(self, chunks):
+        """
+        :param chunks: iterable of bytes of one payload
+        :return: offset, length of the payload's gzip member in the object; None if the shard is sealed
+        """
+        with self.lock:
+            if self.sealed:
+                return None
+            offset = self.file.tell()
+            member = gzip.GzipFile(fileobj=self.file, mode='wb', mtime=0)
+            for chunk in chunks:
+                member.write(chunk)
+            # ends the member; the shard's file stays open
+            member.close()
+            return offset, self.file.tell() - offset
+
+    def seal(self):
+        with self.lock:
+            self.sealed = True
+
+    def upload(self, blob):
+        self.file.seek(0)
+        blob.upload_from_file(self.file, content_type='application/x-ndjson')
+
+    def close(self):
+        self.file.close()
+
+
+class ArchiveWriter(object):
+    """
+    Collects the results of a cron run in gzip compressed NDJSON shards per date and category, instead of an object
+    per user, category and result. Identical payloads are stored once, and a manifest maps each user's results to
+    their byte ranges in the shards. Each checkpoint uploads the shards written since the last one as new parts,
+    and a manifest part of the results added since the last one, so a run that is killed keeps what it has archived;
+    the complete manifest is uploaded at the end of the run
+    """
+
+    def __init__(self, bucket_name, run_id):
+        """
+        :param bucket_name: Cloud Storage bucket of the shards and the manifest
+        :param run_id: unique name of the run, used in the object names
+        """
+        self.bucket_name = bucket_name
+        self.run_id = run_id
+        self.manifest_path = 'archive/manifests/{}.json'.format(run_id)
+        # number of the manifest parts of the checkpoints so far
+        self._checkpoints = 0
+        # (date, category) to the _Shard written to, and to the number of its parts so far
+        self._shards = {}
+        self._parts = {}
+        # every _Shard of the run, closed by close
+        self._all_shards = []
+        # object path to the error of its last failed upload
+        self._errors = {}
+        # sha256 of a payload to its manifest entry
+        self._payloads = {}
+        # username to {category: {part: manifest entry}}, of the run and of the results since the last checkpoint
+        self._manifest = {}
+        self._pending = {}
+        self._lock = Lock()
+
+    def add(self, username, date, category, part, result):
+        """
+        archive a JSON serializable result as one NDJSON line
+        :param username: user the result is for
+        :param date: local date of the result as DATE_FORMAT
+        :param category: steps, calories, activities or heartrate
+        :param part: kind of the result, e.g. get or inserted
+        :param result: JSON serializable result
+        """
+        data = (json.dumps(result, sort_keys=True) + '\n').encode('utf-8')
+        self._add(username, date, category, part, hashlib.sha256(data).hexdigest(), lambda: [data])
+
+    def add_file(self, username, date, category, part, ndjson_file):
+        """
+        archive the lines of an NDJSON file, e.g. the file of an NdjsonArchive
+        :param ndjson_file: file object opened in binary mode; read from its start
+        """
+        digest = hashlib.sha256()
+        for chunk in self._read(ndjson_file):
+            digest.update(chunk)
+        self._add(username, date, category, part, digest.hexdigest(), lambda: self._read(ndjson_file))
+
+    def _read(self, f):
+        f.seek(0)
+        while True:
+            chunk = f.read(COPY_CHUNK_BYTES)
+            if not chunk:
+                return
+            yield chunk
+
+    def _add(self, username, date, category, part, sha256, chunks):
+        while True:
+            with self._lock:
+                entry = self._payloads.get(sha256)
+                if entry is not None:
+                    break
+                shard = self._shards.get((date, category))
+                if shard is None:
+                    n = self._parts.get((date, category), 0)
+                    self._parts[(date, category)] = n + 1
+                    shard = _Shard('archive/{}/{}/{}-{:04d}.ndjson.gz'.format(date, category, self.run_id, n))
+                    self._shards[(date, category)] = shard
+                    self._all_shards.append(shard)
+            written = shard.write(chunks())
+            # a shard sealed by a checkpoint meanwhile is replaced by a new part
+            if written is not None:
+                offset, length = written
+                entry = {'object': shard.path, 'offset': offset, 'length': length, 'sha256': sha256}
+                with self._lock:
+                    entry = self._payloads.setdefault(sha256, entry)
+                break
+        with self._lock:
+            self._manifest.setdefault(username, {}).setdefault(category, {})[part] = entry
+            self._pending.setdefault(username, {}).setdefault(category, {})[part] = entry
+
+    def gs_paths(self, username, category):
+        """
+        :return: bucket/object paths of the shards holding the user's results of the category
+        """
+        with self._lock:
+            entries = self._manifest.get(username, {}).get(category, {}).values()
+            return sorted(set('{}/{}'.format(self.bucket_name, entry['object']) for entry in entries))
+
+    def checkpoint(self, pool_size):
+        """
+        upload the shards written since the last checkpoint in parallel, then a manifest part of the results added
+        since, archive/manifests/<run_id>/<n>.json; later results go to new parts
+        :param pool_size: maximum number of concurrent uploads
+        """
+        self._upload(pool_size, complete=False)
+
+    def upload(self, pool_size):
+        """
+        upload the shards written since the last checkpoint in parallel, then the complete manifest
+        :param pool_size: maximum number of concurrent uploads
+        :return: dict of the object paths of the run that failed to upload to their error
+        """
+        return self._upload(pool_size, complete=True)
+
+    def _upload(self, pool_size, complete):
+        bucket = clients.get_client('storage').bucket(self.bucket_name)
+        with self._lock:
+            shards = list(self._shards.values())
+            self._shards = {}
+            pending = self._pending
+            self._pending = {}
+        for shard in shards:
+            # waits for a payload being written to the shard
+            shard.seal()
+        for shard, err in run_in_pool(lambda shard: shard.upload(bucket.blob(shard.path)), shards, pool_size):
+            self._errors[shard.path] = str(err)
+        for shard in shards:
+            # uploaded or failed, its data isn't needed anymore
+            shard.close()
+        if complete:
+            path = self.manifest_path
+        else:
+            # only the results since the last checkpoint, so that a run's checkpoints upload each entry once
+            path = 'archive/manifests/{}/{:04d}.json'.format(self.run_id, self._checkpoints)
+            self._checkpoints += 1
+        self._errors.pop(path, None)
+        with self._lock:
+            manifest = json.dumps({
+                'run_id': self.run_id,
+                'bucket': self.bucket_name,
+                'complete': complete,
+                'failed_objects': sorted(self._errors),
+                # ranges are of gzip members, each of which decompresses to the NDJSON lines of one result
+                'users': self._manifest if complete else pending,
+            }, sort_keys=True)
+        try:
+            bucket.blob(path).upload_from_string(manifest, content_type='application/json')
+        except Exception as err:
+            self._errors[path] = str(err)
+        return dict(self._errors)
+
+    def failed_categories(self, errors):
+        """
+        :param errors: return value of upload
+        :return: list of (username, category, error) of the results in objects that failed to upload
+        """
+        failed = []
+        for username, categories in self._manifest.items():
+            for category, parts in categories.items():
+                for entry in parts.values():
+                    if entry['object'] in errors:
+                        failed.append((username, category, errors[entry['object']]))
+                        break
+        return failed
+
+    def close(self):
+        for shard in self._all_shards:
+            shard.close()
@@ -1,20 +1,39 @@
+import bisect
+import gzip
+import json
 import os
+import struct
+import tempfile
 import time
 from datetime import datetime, timedelta
+from threading import Lock
 
+import googleapiclient.errors
+import httplib2
 import pytz
 from configparser import ConfigParser
-from google.cloud import bigquery
-from googleapiclient.discovery import build
+from oauth2client import client
 
-from update_google_fit import get_aggregate
+import clients
+from update_google_fit import aggregate_request, get_aggregate, get_aggregates, split_aggregate
 
 DATE_FORMAT = '%Y-%m-%d'
 ONE_DAY_MS = 86400000
+ONE_DAY_NANOS = ONE_DAY_MS * 1000 * 1000
 STEPS_DATASOURCE = "derived:com.google.step_count.delta:com.google.android.gms:estimated_steps"
 CALORIES_DATASOURCE = 'derived:com.google.calories.expended:com.google.android.gms:merge_calories_expended'
 ACTIVITY_DATASOURCE = "derived:com.google.activity.segment:com.google.android.gms:merge_activity_segments"
 HEART_RATE_DATASOURCE = 'derived:com.google.heart_rate.bpm:com.google.android.gms:merge_heart_rate_bpm'
+# data sources aggregated together by get_daily_bundle
+AGGREGATE_DATASOURCES = {
+    'steps': STEPS_DATASOURCE,
+    'calories': CALORIES_DATASOURCE,
+    'activities': ACTIVITY_DATASOURCE,
+    'heartrate': HEART_RATE_DATASOURCE,
+}
+BUNDLE_KINDS = ('steps', 'calories', 'activities', 'heartrate')
+# activity types left out of the activity minutes in MySQL, e.g. still, unknown, sleeping
+BAD_ACTIVITIES = "(0,3,5,109,110,111,112,117,118)"
 epoch0 = datetime(1970, 1, 1, tzinfo=pytz.utc)
 
 # init environment variables and configurations
@@ -27,7 +46,8 @@ if 'APP_CONFIG' in os.environ:
 else:
     APP_CONFIG_FILENAME = 'app.config'
 
-config = ConfigParser()
+# app.config documents its keys with trailing '; ...' comments
+config = ConfigParser(inline_comment_prefixes=(';',))
 config.read(APP_CONFIG_FILENAME)
 API_key = config.get('app_config', 'API_KEY')
 DEFAULT_TIMEZONE = config.get('app_config', 'default_timezone')
@@ -41,14 +61,118 @@ GCP_table_segments = config.get('bigquery_config', 'table_segments')
 GCP_table_steps = config.get('bigquery_config', 'table_steps')
 GCP_table_calories = config.get('bigquery_config', 'table_calories')
 
+# columns identifying a row of each BigQuery table, to skip incoming rows already in the table
+MERGE_KEYS = {
+    GCP_table_steps: ('username', 'recordedLocalDate'),
+    GCP_table_calories: ('username', 'recordedLocalDate'),
+    GCP_table_activities: ('username', 'recordedLocalDate', 'activity_type'),
+    GCP_table_segments: ('username', 'recordedLocalDate', 'startTimeNanos'),
+    GCP_table_heartrate: ('username', 'recordedTimeNanos'),
+}
+# tables insert_rows streams to. BigQuery rejects a MERGE that updates rows still in a table's streaming buffer,
+# so their rows are never updated, only inserted when missing; a heart rate data point doesn't change anyway
+STREAMED_TABLES = (GCP_table_heartrate,)
+# rows per MERGE statement, keeping the query parameters under BigQuery's query size limit
+MERGE_BATCH_ROWS = 5000
+# BigQuery table schema field types to standard SQL query parameter types
+QUERY_PARAMETER_TYPES = {'INTEGER': 'INT64', 'FLOAT': 'FLOAT64', 'BOOLEAN': 'BOOL'}
+# heart rate data points per page of Google fitness API and rows per insert, bounding memory of long ranges
+HEART_RATE_PAGE_POINTS = 10000
+HEART_RATE_CHUNK_ROWS = 10000
+# how the cron writes rows to BigQuery: streaming to insert each user's heart rate rows and MERGE the other rows
+# of every batch of users, load for one LoadJobSink per run
+CRON_SINK = config.get('bigquery_config', 'cron_sink', fallback='streaming')
+
+# seconds a user's credentials and timezone from Cloud Datastore are reused before reading them again
+CREDENTIALS_CACHE_TTL = config.getint('app_config', 'credentials_cache_ttl', fallback=900)
+# days before the last sync that update_google_fit gets again, as Google Fit data of recent days still arrives
+RESYNC_DAYS = config.getint('app_config', 'resync_days', fallback=3)
+# hours before the heart rate watermark fetched again, as phones sync their data points to Google Fit late;
+# the data points of these hours already in BigQuery are skipped by MERGE
+HEART_RATE_OVERLAP_HOURS = config.getint('app_config', 'heart_rate_overlap_hours', fallback=6)
+# threads of each main.py process running background jobs such as the backfill of a new user
+JOB_WORKERS = config.getint('app_config', 'job_workers', fallback=2)
+# seconds main.py serves the leaderboards from memory before querying MySQL again
+LEADERBOARD_CACHE_TTL = config.getint('app_config', 'leaderboard_cache_ttl', fallback=60)
+# worker threads of one insert_daily_fitness run, and users processed at once across concurrent runs
+FIT_POOL_SIZE = config.getint('app_config', 'fit_pool_size', fallback=16)
+FIT_MAX_CONCURRENCY = config.getint('app_config', 'fit_max_concurrency', fallback=32)
+# users whose Google Fitness API requests share one batch HTTP request
+FIT_BATCH_SIZE = config.getint('app_config', 'fit_batch_size', fallback=50)
+# calls of a cron category per user at most, and the seconds of the first and the longest backoff between them
+RETRY_MAX_ATTEMPTS = config.getint('app_config', 'retry_max_attempts', fallback=3)
+RETRY_BASE_DELAY = config.getfloat('app_config', 'retry_base_delay', fallback=1.0)
+RETRY_MAX_DELAY = config.getfloat('app_config', 'retry_max_delay', fallback=60.0)
+# retries a cron run may spend on a category, as a fraction of its users, and at least 10
+RETRY_BUDGET_RATIO = config.getfloat('app_config', 'retry_budget_ratio', fallback=0.2)
+# seconds every cron thread pauses after Google Fitness API reports the project's quota exhausted without Retry-After
+QUOTA_PAUSE = config.getint('app_config', 'quota_pause', fallback=60)
+# Cloud Datastore kind of the backfill jobs, the days of their windows and the threads of a job
+BACKFILL_KIND = config.get('app_config', 'backfill_kind', fallback='backfill_job')
+BACKFILL_WINDOW_DAYS = config.getint('app_config', 'backfill_window_days', fallback=30)
+BACKFILL_POOL_SIZE = config.getint('app_config', 'backfill_pool_size', fallback=8)
+# seconds a process holds a backfill job without renewing its lease, after which the job is reported interrupted
+BACKFILL_LEASE = config.getint('app_config', 'backfill_lease', fallback=300)
+
+_client_secret = None
+# BigQuery tables by name, read once per process as their schemas don't change while it runs
+_tables = {}
+_tables_lock = Lock()
+OAUTH_SCOPES = ["profile", "email", 'https://www.googleapis.com/auth/fitness.activity.read',
+                'https://www.googleapis.com/auth/fitness.body.read']
+
+
+def load_client_secret():
+    """
+    read the OAuth client ID and secret from client_secret_file once per process
+    :return: client ID, client secret
+    """
+    global _client_secret
+    if _client_secret is None:
+        with open(client_secret_file) as f:
+            client_secret_json = json.load(f)
+            _client_secret = (client_secret_json['web']['client_id'], client_secret_json['web']['client_secret'])
+    return _client_secret
+
+
+class _ClientSecretsCache(object):
+    """
+    in-process cache of oauth2client.clientsecrets, which otherwise reads and parses client_secret_file for every flow
+    """
+
+    def __init__(self):
+        self._values = {}
+
+    def get(self, key, namespace=None):
+        return self._values.get((namespace, key))
+
+    def set(self, key, value, namespace=None):
+        self._values[(namespace, key)] = value
+
+
+_client_secrets_cache = _ClientSecretsCache()
+
+
+def make_oauth_flow(redirect_uri):
+    """
+    OAuth flow asking for offline access to OAUTH_SCOPES, from the client secrets read once per process
+    :param redirect_uri: URI Google redirects to with the authorization code
+    :return: oauth2client flow
+    """
+    flow = client.flow_from_clientsecrets(client_secret_file, scope=OAUTH_SCOPES, redirect_uri=redirect_uri,
+                                          cache=_client_secrets_cache)
+    flow.params['access_type'] = 'offline'
+    flow.params['prompt'] = 'consent'
+    return flow
+
 
 def current_milli_time():
     return int(round(time.time() * 1000))
 
 
 def list_datasources(http_auth):
-    fit_service = build('fitness', 'v1', http=http_auth)
-    return fit_service.users().dataSources().list(userId="me").execute()
+    fit_service = clients.get_service('fitness', 'v1')
+    return fit_service.users().dataSources().list(userId="me").execute(http=http_auth)
 
 
 def get_daily_calories(http_auth, start_year, start_month, start_day, end_time_millis, local_timezone=DEFAULT_TIMEZONE):
@@ -62,13 +186,20 @@ def get_daily_calories(http_auth, start_year, start_month, start_day, end_time_m
     :param local_timezone: timezone such as US/Pacific, one of the pytz.all_timezones
     :return: dict of daily calory and data source ID
     """
-    # calculate the timestamp in local time to query Google fitness API
-    local_0_hour = pytz.timezone(local_timezone).localize(datetime(start_year, start_month, start_day))
-    start_time_millis = int((local_0_hour - epoch0).total_seconds() * 1000)
-    fit_service = build('fitness', 'v1', http=http_auth)
-    daily_calories = {}
+    start_time_millis = local_start_millis(start_year, start_month, start_day, local_timezone)
+
+    calory_data = get_aggregate(http_auth, start_time_millis, end_time_millis, CALORIES_DATASOURCE)
+    return parse_daily_calories(calory_data, local_timezone)
+
 
-    calory_data = get_aggregate(fit_service, start_time_millis, end_time_millis, CALORIES_DATASOURCE)
+def parse_daily_calories(calory_data, local_timezone=DEFAULT_TIMEZONE):
+    """
+    Parse the calories aggregate response of Google fitness API
+    :param calory_data: aggregate response of CALORIES_DATASOURCE bucketed by day
+    :param local_timezone: timezone such as US/Pacific, one of the pytz.all_timezones
+    :return: dict of daily calory and data source ID
+    """
+    daily_calories = {}
     for daily_calory_data in calory_data['bucket']:
         # use local date as the key
         local_date = datetime.fromtimestamp(int(daily_calory_data['startTimeMillis']) / 1000,
@@ -95,13 +226,20 @@ def get_daily_steps(http_auth, start_year, start_month, start_day, end_time_mill
     :param local_timezone: timezone such as US/Pacific, one of the pytz.all_timezones
     :return: dict of daily steps and data source ID
     """
-    # calculate the timestamp in local time to query Google fitness API
-    local_0_hour = pytz.timezone(local_timezone).localize(datetime(start_year, start_month, start_day))
-    start_time_millis = int((local_0_hour - epoch0).total_seconds() * 1000)
-    fit_service = build('fitness', 'v1', http=http_auth)
-    steps = {}
+    start_time_millis = local_start_millis(start_year, start_month, start_day, local_timezone)
+
+    steps_data = get_aggregate(http_auth, start_time_millis, end_time_millis, STEPS_DATASOURCE)
+    return parse_daily_steps(steps_data, local_timezone)
 
-    steps_data = get_aggregate(fit_service, start_time_millis, end_time_millis, STEPS_DATASOURCE)
+
+def parse_daily_steps(steps_data, local_timezone=DEFAULT_TIMEZONE):
+    """
+    Parse the steps aggregate response of Google fitness API
+    :param steps_data: aggregate response of STEPS_DATASOURCE bucketed by day
+    :param local_timezone: timezone such as US/Pacific, one of the pytz.all_timezones
+    :return: dict of daily steps and data source ID
+    """
+    steps = {}
     for daily_step_data in steps_data['bucket']:
         # use local date as the key
         local_date = datetime.fromtimestamp(int(daily_step_data['startTimeMillis']) / 1000,
@@ -129,13 +267,24 @@ def get_daily_activities(http_auth, start_year, start_month, start_day, end_time
     :param local_timezone: timezone such as US/Pacific, one of the pytz.all_timezones
     :return: dict of daily activities and its data sets
     """
-    # calculate the timestamp in local time to query Google fitness API
-    local_0_hour = pytz.timezone(local_timezone).localize(datetime(start_year, start_month, start_day))
-    start_time_millis = int((local_0_hour - epoch0).total_seconds() * 1000)
-    fit_service = build('fitness', 'v1', http=http_auth)
-    activities = {}
+    start_time_millis = local_start_millis(start_year, start_month, start_day, local_timezone)
+
+    activityData = get_aggregate(http_auth, start_time_millis, end_time_millis, ACTIVITY_DATASOURCE)
+    return parse_daily_activities(http_auth, activityData, local_timezone)
 
-    activityData = get_aggregate(fit_service, start_time_millis, end_time_millis, ACTIVITY_DATASOURCE)
+
+def parse_daily_activities(http_auth, activityData, local_timezone=DEFAULT_TIMEZONE, activity_dataset=None):
+    """
+    Parse the activities aggregate response of Google fitness API and get the activity segments of each day
+    :param http_auth: username authenticated HTTP client to call Google API
+    :param activityData: aggregate response of ACTIVITY_DATASOURCE bucketed by day
+    :param local_timezone: timezone such as US/Pacific, one of the pytz.all_timezones
+    :param activity_dataset: ACTIVITY_DATASOURCE dataset of activity_dataset_range; requested when None
+    :return: dict of daily activities and its data sets
+    """
+    activities = {}
+    # (local date, start, end) in nanoseconds of each day to split the activity segments by
+    day_ranges = []
     for daily_activity in activityData['bucket']:
         # use local date as the key
         local_date = datetime.fromtimestamp(int(daily_activity['startTimeMillis']) / 1000,
@@ -161,20 +310,275 @@ def get_daily_activities(http_auth, start_year, start_month, start_day, end_time
                     'segments': n_segments,
                 })
 
-        # get activity datasets
         start_time_nanos = int((local_date - epoch0).total_seconds() * 1000 * 1000 * 1000)
-        end_time_nanos = start_time_nanos + 86400000000000
-        activity_datasetId = '{}-{}'.format(start_time_nanos, end_time_nanos)
-        print('calling Google Fitness API to get activity segment from dataSetId {}'.format(
-            activity_datasetId))
-        activity_dataset = fit_service.users().dataSources().datasets().get(userId="me",
-                                                                            dataSourceId=ACTIVITY_DATASOURCE,
-                                                                            datasetId=activity_datasetId).execute()
-        activities[local_date_str]['activity_dataset'] = activity_dataset
+        day_ranges.append((local_date_str, start_time_nanos, start_time_nanos + ONE_DAY_NANOS))
+
+    # get activity datasets of all days at once and split them by day
+    if day_ranges:
+        if activity_dataset is None:
+            activity_dataset = get_dataset(http_auth, ACTIVITY_DATASOURCE, *activity_dataset_range(activityData))
+        daily_datasets = partition_dataset(activity_dataset, [(start, end) for _, start, end in day_ranges])
+        for (local_date_str, _, _), daily_dataset in zip(day_ranges, daily_datasets):
+            activities[local_date_str]['activity_dataset'] = daily_dataset
 
     return activities
 
 
+def activity_dataset_range(activityData):
+    """
+    time range of the activity segments of an activities aggregate's days
+    :param activityData: aggregate response of ACTIVITY_DATASOURCE bucketed by day
+    :return: start, end in nanoseconds Unix Epoch time; None if there are no days
+    """
+    if not activityData['bucket']:
+        return None
+    start_time_nanos = int(activityData['bucket'][0]['startTimeMillis']) * 1000 * 1000
+    end_time_nanos = int(activityData['bucket'][-1]['startTimeMillis']) * 1000 * 1000 + ONE_DAY_NANOS
+    return start_time_nanos, end_time_nanos
+
+
+def get_dataset(http_auth, data_source_id, start_time_nanos, end_time_nanos):
+    """
+    get a data source's dataset of a whole time range from Google fitness API, following the response pages
+    :param http_auth: username authenticated HTTP client to call Google API
+    :param data_source_id: data source ID such as ACTIVITY_DATASOURCE
+    :param start_time_nanos: start of the range in nanoseconds Unix Epoch time
+    :param end_time_nanos: end of the range in nanoseconds Unix Epoch time
+    :return: dataset with the data points of every page
+    """
+    dataset = None
+    for page in iter_dataset_pages(http_auth, data_source_id, start_time_nanos, end_time_nanos):
+        if dataset is None:
+            dataset = page
+        else:
+            dataset['point'].extend(page['point'])
+    dataset.pop('nextPageToken', None)
+    return dataset
+
+
+def iter_dataset_pages(http_auth, data_source_id, start_time_nanos, end_time_nanos, page_size=None):
+    """
+    get a data source's dataset of a time range from Google fitness API page by page
+    :param http_auth: username authenticated HTTP client to call Google API
+    :param data_source_id: data source ID such as ACTIVITY_DATASOURCE
+    :param start_time_nanos: start of the range in nanoseconds Unix Epoch time
+    :param end_time_nanos: end of the range in nanoseconds Unix Epoch time
+    :param page_size: maximum data points per page, None for Google fitness API's default
+    :return: generator of datasets, each holding the data points of one page
+    """
+    datasetId = '{}-{}'.format(start_time_nanos, end_time_nanos)
+    print('calling Google Fitness API to get {} from dataSetId {}'.format(data_source_id, datasetId))
+    datasets = clients.get_service('fitness', 'v1').users().dataSources().datasets()
+    request_kwargs = {'userId': "me", 'dataSourceId': data_source_id, 'datasetId': datasetId}
+    if page_size is not None:
+        request_kwargs['limit'] = page_size
+    page = datasets.get(**request_kwargs).execute(http=http_auth)
+    page.setdefault('point', [])
+    yield page
+    while page.get('nextPageToken'):
+        page = datasets.get(pageToken=page['nextPageToken'], **request_kwargs).execute(http=http_auth)
+        page.setdefault('point', [])
+        yield page
+
+
+def partition_dataset(dataset, time_ranges):
+    """
+    split a dataset into one dataset per time range, as if each range had been requested on its own;
+    Google fitness API returns the points overlapping a range, so a point spanning two ranges is in both
+    :param dataset: dataset from get_dataset covering all time_ranges
+    :param time_ranges: sorted, non overlapping list of (start, end) in nanoseconds Unix Epoch time
+    :return: list of datasets in the order of time_ranges
+    """
+    starts = [start for start, _ in time_ranges]
+    ends = [end for _, end in time_ranges]
+    partitions = [{
+        'dataSourceId': dataset.get('dataSourceId'),
+        'minStartTimeNs': str(start),
+        'maxEndTimeNs': str(end),
+        'point': [],
+    } for start, end in time_ranges]
+
+    for point in dataset.get('point', []):
+        point_start = int(point['startTimeNanos'])
+        point_end = int(point['endTimeNanos'])
+        # first range that ends at or after the point's start, then every range starting before the point's end
+        i = bisect.bisect_left(ends, point_start)
+        while i < len(time_ranges) and starts[i] <= point_end:
+            partitions[i]['point'].append(point)
+            i += 1
+    return partitions
+
+
+def get_daily_bundle(http_auth, start_year, start_month, start_day, end_time_millis,
+                     local_timezone=DEFAULT_TIMEZONE, kinds=BUNDLE_KINDS):
+    """
+    Get several kinds of user's daily data with a single Google fitness aggregate request
+    :param http_auth: username authenticated HTTP client to call Google API
+    :param start_year: start getting data from local date's year
+    :param start_month: start getting data from local date's month
+    :param start_day: start getting data from local date's day
+    :param end_time_millis: getting data up to the end datetime in milliseconds Unix Epoch time
+    :param local_timezone: timezone such as US/Pacific, one of the pytz.all_timezones
+    :param kinds: any of 'steps', 'calories', 'activities', 'heartrate'
+    :return: dict of kind to the return value of get_daily_<kind>; 'heartrate' maps to the aggregate response
+    expected by get_and_insert_heart_rate
+    """
+    start_time_millis = local_start_millis(start_year, start_month, start_day, local_timezone)
+
+    kinds = list(kinds)
+    aggregates = get_aggregates(http_auth, start_time_millis, end_time_millis,
+                                [AGGREGATE_DATASOURCES[kind] for kind in kinds])
+    return parse_bundle(http_auth, dict(zip(kinds, aggregates)), local_timezone)
+
+
+def parse_bundle(http_auth, aggregates, local_timezone=DEFAULT_TIMEZONE, activity_dataset=None):
+    """
+    parse each kind's aggregate response the way get_daily_<kind> does
+    :param http_auth: username authenticated HTTP client to call Google API
+    :param aggregates: dict of kind to its aggregate response with a single dataset per bucket
+    :param local_timezone: timezone such as US/Pacific, one of the pytz.all_timezones
+    :param activity_dataset: ACTIVITY_DATASOURCE dataset of activity_dataset_range; requested when None
+    :return: dict of kind to the return value of get_daily_<kind>; 'heartrate' maps to the aggregate response
+    """
+    bundle = {}
+    for kind, aggregate in aggregates.items():
+        if kind == 'steps':
+            bundle[kind] = parse_daily_steps(aggregate, local_timezone)
+        elif kind == 'calories':
+            bundle[kind] = parse_daily_calories(aggregate, local_timezone)
+        elif kind == 'activities':
+            bundle[kind] = parse_daily_activities(http_auth, aggregate, local_timezone, activity_dataset)
+        else:
+            bundle[kind] = aggregate
+    return bundle
+
+
+def prefetch_bundles(flows, batch_size=FIT_BATCH_SIZE):
+    """
+    fetch the bundles of many users' UserDataFlow with Google API batch requests. Each batch carries batch_size users'
+    aggregate requests, each authorized as its own user, in one HTTP round trip, and a second batch gets the same
+    users' activity segments. Only the users holding a valid access token are batched, see refresh_access_token.
+    A flow without one or whose requests failed is left without a bundle and fetches it on its own
+    :param flows: list of UserDataFlow
+    :param batch_size: users per batch request
+    :return: list of (username, exception) of the flows left without a bundle
+    """
+    fit_service = clients.get_service('fitness', 'v1')
+    failures = []
+    # a token refreshed inside the batch request, e.g. a revoked one, would fail every user of the batch
+    valid_flows = []
+    for flow in flows:
+        if has_access_token(flow.http_auth):
+            valid_flows.append(flow)
+        else:
+            failures.append((flow.username, RuntimeError('no valid access token')))
+    flows = valid_flows
+    for i in range(0, len(flows), batch_size):
+        chunk = flows[i:i + batch_size]
+        try:
+            aggregates = execute_batch(fit_service, [
+                (flow.http_auth, aggregate_request(
+                    local_start_millis(flow.start_year, flow.start_month, flow.start_day, flow.local_timezone),
+                    flow.end_time_millis, [AGGREGATE_DATASOURCES[kind] for kind in flow.kinds]))
+                for flow in chunk])
+        except Exception as e:
+            # e.g. a transport error fails the whole batch
+            print('batch of {} users failed, each gets its bundle on its own: {}'.format(len(chunk), e))
+            failures.extend((flow.username, e) for flow in chunk)
+            continue
+        aggregates = [None if aggregate is None else dict(zip(flow.kinds, split_aggregate(aggregate, len(flow.kinds))))
+                      for flow, aggregate in zip(chunk, aggregates)]
+
+        # activity segments of the users whose aggregates came back with days of activities
+        segment_requests = {}
+        for n, kind_aggregates in enumerate(aggregates):
+            if kind_aggregates is not None and 'activities' in kind_aggregates:
+                time_range = activity_dataset_range(kind_aggregates['activities'])
+                if time_range is not None:
+                    segment_requests[n] = fit_service.users().dataSources().datasets().get(
+                        userId="me", dataSourceId=ACTIVITY_DATASOURCE, datasetId='{}-{}'.format(*time_range))
+        try:
+            segments = dict(zip(segment_requests.keys(), execute_batch(
+                fit_service, [(chunk[n].http_auth, request) for n, request in segment_requests.items()])))
+        except Exception as e:
+            # parse_bundle gets the segments of each user instead
+            print('batch of {} users\' activity segments failed: {}'.format(len(segment_requests), e))
+            segments = {}
+
+        for n, (flow, kind_aggregates) in enumerate(zip(chunk, aggregates)):
+            if kind_aggregates is None:
+                failures.append((flow.username, RuntimeError('batched aggregate request failed')))
+                continue
+            activity_dataset = segments.get(n)
+            if activity_dataset is not None and activity_dataset.get('nextPageToken'):
+                # rare; parse_bundle gets every page of it instead
+                activity_dataset = None
+            elif activity_dataset is not None:
+                activity_dataset.setdefault('point', [])
+            try:
+                flow.bundle = parse_bundle(flow.http_auth, kind_aggregates, flow.local_timezone, activity_dataset)
+            except Exception as e:
+                print('unable to prefetch bundle for user {}: {}'.format(flow.username, e))
+                failures.append((flow.username, e))
+    return failures
+
+
+def refresh_access_token(http_auth):
+    """
+    get an access token for an authenticated HTTP client's credentials unless they hold a valid one
+    :param http_auth: user authenticated HTTP client from the credentials' authorize
+    :raise oauth2client.client.HttpAccessTokenRefreshError: the user's refresh token is invalid, e.g. revoked
+    """
+    # HTTP request to Google's token endpoint when the token is missing or expired
+    http_auth.request.credentials.get_access_token(httplib2.Http())
+
+
+def has_access_token(http_auth):
+    """
+    :param http_auth: user authenticated HTTP client from the credentials' authorize
+    :return: whether its credentials hold an access token that has not expired
+    """
+    credentials = http_auth.request.credentials
+    return credentials.access_token is not None and not credentials.access_token_expired
+
+
+def execute_batch(service, requests):
+    """
+    execute requests of different users in Google API batch requests
+    :param service: service from clients.get_service that created the requests
+    :param requests: list of (user's authenticated HTTP client, unexecuted HttpRequest)
+    :return: list of responses in the order of requests, None for the requests that failed
+    """
+    responses = [None] * len(requests)
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            responses[int(request_id)] = response
+        else:
+            print('batched request {} failed: {}'.format(request_id, exception))
+
+    if requests:
+        batch = service.new_batch_http_request(callback=callback)
+        for n, (http_auth, request) in enumerate(requests):
+            # every part of the batch is authorized with its own user's credentials
+            request.http = http_auth
+            batch.add(request, request_id=str(n))
+        # the batch itself needs no credentials. googleapiclient refreshes the token of a part rejected with 401 and
+        # sends it again, but a refresh failing there raises for the whole batch
+        batch.execute(http=httplib2.Http())
+    return responses
+
+
+def local_start_millis(start_year, start_month, start_day, local_timezone=DEFAULT_TIMEZONE):
+    """
+    calculate the 0 hour of a local date in milliseconds Unix Epoch time to query Google fitness API
+    :param local_timezone: timezone such as US/Pacific, one of the pytz.all_timezones
+    :return: milliseconds Unix Epoch time of the local date's 0 hour
+    """
+    local_0_hour = pytz.timezone(local_timezone).localize(datetime(start_year, start_month, start_day))
+    return int((local_0_hour - epoch0).total_seconds() * 1000)
+
+
 def calc_n_days_ago(past_n_days, local_timezone=pytz.timezone(DEFAULT_TIMEZONE)):
     """
     calculate the 0 hour datetime n days ago in milliseconds Unix Epoch time
@@ -193,10 +597,16 @@ def calc_n_days_ago(past_n_days, local_timezone=pytz.timezone(DEFAULT_TIMEZONE))
 
 
 def get_and_insert_heart_rate(http_auth, username, start_year, start_month, start_day, end_time_millis,
-                              local_timezone=DEFAULT_TIMEZONE):
+                              local_timezone=DEFAULT_TIMEZONE, heartrate_data=None, watermark_nanos=None,
+                              overlap_nanos=None, sink=None, archive=None, on_flush=None):
     """
     call Google Fitness API for user's heart rate bmp numbers and
-    insert them to a BigQuery table except existing_rows of recordedTimeNanos
+    insert them to a BigQuery table except existing rows of recordedTimeNanos.
+    The data points are fetched page by page and inserted every HEART_RATE_CHUNK_ROWS rows, so memory use does not
+    grow with the date range. With a watermark, the data points from HEART_RATE_OVERLAP_HOURS before it are fetched:
+    the ones of the overlap already inserted are skipped, and the others, after it or synced late, are inserted.
+    Without the overlap's recordedTimeNanos, the rows at or before the watermark are MERGEd instead, and without
+    a watermark, e.g. the first ingest of a user or a backfill, all rows are MERGEd to skip the existing ones
     :param http_auth: username authenticated HTTP client to call Google API
     :param username: user's Gmail
     :param start_year: start getting heart rate data from local date's year
@@ -204,28 +614,30 @@ def get_and_insert_heart_rate(http_auth, username, start_year, start_month, star
     :param start_day: start getting heart rate data from local date's day
     :param end_time_millis: getting heart rate data up to the end datetime in milliseconds Unix Epoch time
     :param local_timezone: timezone such as US/Pacific, one of the pytz.all_timezones
-    :return: heart rate insert log, data set, no heart rate dates, count of inserted rows
+    :param heartrate_data: heart rate aggregate response from get_daily_bundle; requested when None
+    :param watermark_nanos: latest recordedTimeNanos already inserted for the user, or None
+    :param overlap_nanos: recordedTimeNanos already inserted for the user from HEART_RATE_OVERLAP_HOURS before the
+    watermark on, or None if unknown
+    :param sink: LoadJobSink to write the rows to instead of inserting them now
+    :param archive: function of local date and a dataset with a page of that day's data points, called for every
+    page instead of returning the datasets in heart_datasets
+    :param on_flush: function of the new watermark and overlap, called whenever a chunk of rows is inserted;
+    the overlap is None when the data points fetched can't tell every row of it in the table
+    :return: heart rate insert log, data set, no heart rate dates, count of inserted rows, new watermark
     """
-    # calculate the timestamp in local time to query Google fitness API
-    local_0_hour = pytz.timezone(local_timezone).localize(datetime(start_year, start_month, start_day))
-    start_time_millis = int((local_0_hour - epoch0).total_seconds() * 1000)
-    fit_service = build('fitness', 'v1', http=http_auth)
+    start_time_millis = local_start_millis(start_year, start_month, start_day, local_timezone)
 
     # method return values
-    no_heart_rate_log = 'no heart rate data in the following days: ['
-    heart_rate_log = '['
+    no_heart_rate_log = []
+    heart_rate_log = []
     heart_dataset_list = []
-
-    heartrate_data = get_aggregate(fit_service, start_time_millis, end_time_millis, HEART_RATE_DATASOURCE)
-    bigquery_client = bigquery.Client()
     inserted_count = 0
-    rows_to_insert = []
-    query = "SELECT recordedTimeNanos FROM `{}.{}.{}` WHERE username = '{}' AND recordedLocalDate >= '{}'".format(
-        GCP_project, GCP_dataset, GCP_table_heartrate, username, "{}-{}-{}".format(start_year, start_month, start_day))
-    query_job = bigquery_client.query(query)
-    existing_rows = list(query_job.result())
-    existing_rows = [row['recordedTimeNanos'] for row in existing_rows]
 
+    if heartrate_data is None:
+        heartrate_data = get_aggregate(http_auth, start_time_millis, end_time_millis, HEART_RATE_DATASOURCE)
+
+    # (local date, start, end) in nanoseconds of each day having heart rate data
+    heart_days = []
     for daily_item in heartrate_data['bucket']:
         incoming_day_localized = datetime.fromtimestamp(int(daily_item['startTimeMillis']) / 1000,
                                                         tz=pytz.timezone(local_timezone))
@@ -235,63 +647,374 @@ def get_and_insert_heart_rate(http_auth, username, start_year, start_month, star
             startTimeNanos = data_point[0]['startTimeNanos']
             endTimeNanos = data_point[0]['endTimeNanos']
             heart_datasetId = '{}-{}'.format(startTimeNanos, endTimeNanos)
-            heart_rate_log += '"on day {}, heart rate datasetId: {}", '.format(
-                incoming_day_localized_str, heart_datasetId)
-            print('calling Google Fitness API to get heart rate from dataSetId {} for user {}'.format(
-                heart_datasetId, username))
-            heart_dataset = fit_service.users().dataSources().datasets().get(userId="me",
-                                                                             dataSourceId=HEART_RATE_DATASOURCE,
-                                                                             datasetId=heart_datasetId).execute()
-            heart_dataset_list.append(heart_dataset)
+            heart_rate_log.append('"on day {}, heart rate datasetId: {}"'.format(
+                incoming_day_localized_str, heart_datasetId))
+            heart_days.append((incoming_day_localized_str, int(startTimeNanos), int(endTimeNanos)))
         else:
-            no_heart_rate_log += '"{}", '.format(incoming_day_localized_str)
-            continue
+            no_heart_rate_log.append('"{}"'.format(incoming_day_localized_str))
 
-        # insert heart rate daily entries to BigQuery tables except existing rows
-        if heart_dataset['point']:
-            data_point_list = heart_dataset['point']
-            for bpm_data_point in data_point_list:
-                if int(bpm_data_point['endTimeNanos']) not in existing_rows:
-                    # username, recordedTimeNanos, recordedLocalDate, bpm
-                    rows_to_insert.append(
-                        (username, int(bpm_data_point['endTimeNanos']), incoming_day_localized_str,
-                         int(bpm_data_point['value'][0]['fpVal'])))
-
-    if rows_to_insert:
-        dataset_ref = bigquery_client.dataset(GCP_dataset)
-        table_ref = dataset_ref.table(GCP_table_heartrate)
-        table = bigquery_client.get_table(table_ref)
-        # BigQuery API request
-        errors = bigquery_client.insert_rows(table, rows_to_insert)
-        if errors:
-            raise Exception(str(errors))
-        inserted_count = len(rows_to_insert)
-    return {
-        'heart_rate_log': heart_rate_log + ']',
-        'no_heart_rate_log': no_heart_rate_log + ']',
-        'heart_datasets': heart_dataset_list,
+    overlap_span_nanos = HEART_RATE_OVERLAP_HOURS * 3600 * 10 ** 9
+    # get heart rate datasets of all days at once, from the overlap before the watermark on
+    fetch_start_nanos = heart_days[0][1] if heart_days else None
+    if heart_days and watermark_nanos is not None:
+        fetch_start_nanos = max(fetch_start_nanos, watermark_nanos - overlap_span_nanos)
+
+    rows_to_insert = []
+    # recordedTimeNanos of the rows in rows_to_insert, as the same point can be in two days' datasets
+    pending_rows = set()
+    # recordedTimeNanos in the table from the overlap before the watermark on, skipped when they come again
+    known_overlap = watermark_nanos is not None and overlap_nanos is not None
+    inserted_rows = set(overlap_nanos) if known_overlap else set()
+    new_watermark_nanos = watermark_nanos
+
+    def new_overlap():
+        # without the stored overlap, rows inserted earlier may be in it unless it was fetched from its start
+        if known_overlap or fetch_start_nanos <= new_watermark_nanos - overlap_span_nanos:
+            return sorted(inserted_rows)
+        return None
+
+    def flush():
+        if not rows_to_insert:
+            return 0
+        if sink is not None:
+            count = sink.write(GCP_table_heartrate, username, rows_to_insert)
+        elif known_overlap:
+            # rows of the overlap in the table were skipped; the others synced late or are after the watermark
+            count = insert_rows(GCP_table_heartrate, rows_to_insert)
+        elif watermark_nanos is None:
+            # BigQuery API request; rows already in the table are skipped by MERGE
+            count = merge_rows(GCP_table_heartrate, rows_to_insert)
+        else:
+            # rows of the overlap may be in the table already; the ones after the watermark can't be
+            count = merge_rows(GCP_table_heartrate, [row for row in rows_to_insert if row[1] <= watermark_nanos])
+            count += insert_rows(GCP_table_heartrate, [row for row in rows_to_insert if row[1] > watermark_nanos])
+        del rows_to_insert[:]
+        inserted_rows.update(pending_rows)
+        pending_rows.clear()
+        inserted_rows.difference_update([nanos for nanos in inserted_rows
+                                         if nanos < new_watermark_nanos - overlap_span_nanos])
+        if on_flush is not None:
+            on_flush(new_watermark_nanos, new_overlap())
+        return count
+
+    if heart_days:
+        # split each page by day
+        if fetch_start_nanos <= heart_days[-1][2]:
+            print('calling Google Fitness API to get heart rate of {} days for user {}'.format(len(heart_days),
+                                                                                               username))
+            pages = iter_dataset_pages(http_auth, HEART_RATE_DATASOURCE, fetch_start_nanos, heart_days[-1][2],
+                                       page_size=HEART_RATE_PAGE_POINTS)
+        else:
+            pages = []
+        for page in pages:
+            daily_pages = partition_dataset(page, [(start, end) for _, start, end in heart_days])
+            for (incoming_day_localized_str, _, _), heart_dataset in zip(heart_days, daily_pages):
+                if not heart_dataset['point']:
+                    continue
+                if archive is not None:
+                    archive(incoming_day_localized_str, heart_dataset)
+                else:
+                    heart_dataset_list.append(heart_dataset)
+
+                # insert heart rate daily entries to BigQuery tables except existing rows
+                for bpm_data_point in heart_dataset['point']:
+                    recorded_time_nanos = int(bpm_data_point['endTimeNanos'])
+                    if recorded_time_nanos not in pending_rows and recorded_time_nanos not in inserted_rows:
+                        pending_rows.add(recorded_time_nanos)
+                        # username, recordedTimeNanos, recordedLocalDate, bpm
+                        rows_to_insert.append(
+                            (username, recorded_time_nanos, incoming_day_localized_str,
+                             int(bpm_data_point['value'][0]['fpVal'])))
+                    # data points come in time order; every point seen is in BigQuery once its chunk is flushed
+                    if new_watermark_nanos is None or recorded_time_nanos > new_watermark_nanos:
+                        new_watermark_nanos = recorded_time_nanos
+            if len(rows_to_insert) >= HEART_RATE_CHUNK_ROWS:
+                inserted_count += flush()
+    inserted_count += flush()
+
+    result = {
+        'heart_rate_log': '[' + ', '.join(heart_rate_log) + ']',
+        'no_heart_rate_log': 'no heart rate data in the following days: [' + ', '.join(no_heart_rate_log) + ']',
         'inserted_count': inserted_count,
+        'watermark_nanos': new_watermark_nanos,
     }
+    if archive is None:
+        result['heart_datasets'] = heart_dataset_list
+    return result
+
+
+def get_table(table_name):
+    """
+    :param table_name: one of the GCP_table_* tables
+    :return: the BigQuery Table with its schema, requested on first use only
+    """
+    table = _tables.get(table_name)
+    if table is None:
+        with _tables_lock:
+            table = _tables.get(table_name)
+            if table is None:
+                bigquery_client = clients.get_client('bigquery')
+                # BigQuery API request
+                table = bigquery_client.get_table(bigquery_client.dataset(GCP_dataset).table(table_name))
+                _tables[table_name] = table
+    return table
+
+
+def merge_rows(table_name, rows):
+    """
+    insert rows to a BigQuery table except the rows whose MERGE_KEYS columns match a row in the table,
+    with one MERGE statement per MERGE_BATCH_ROWS rows instead of querying the existing rows first.
+    Rows of several users can be merged together
+    :param table_name: one of the GCP_table_* tables
+    :param rows: list of tuples in the order of the table's columns
+    :return: inserted row count
+    """
+    from google.cloud import bigquery
+    if not rows:
+        return 0
+    bigquery_client = clients.get_client('bigquery')
+    table = get_table(table_name)
+    columns = [(field.name, QUERY_PARAMETER_TYPES.get(field.field_type, field.field_type)) for field in table.schema]
+    query = merge_query(table_name, 'UNNEST(@rows)', [name for name, _ in columns])
+
+    inserted_count = 0
+    for i in range(0, len(rows), MERGE_BATCH_ROWS):
+        job_config = bigquery.QueryJobConfig()
+        job_config.query_parameters = [bigquery.ArrayQueryParameter('rows', 'STRUCT', [
+            bigquery.StructQueryParameter(None, *[bigquery.ScalarQueryParameter(name, parameter_type, value)
+                                                  for (name, parameter_type), value in zip(columns, row)])
+            for row in rows[i:i + MERGE_BATCH_ROWS]])]
+        # BigQuery API request
+        query_job = bigquery_client.query(query, job_config=job_config)
+        query_job.result()
+        inserted_count += query_job.num_dml_affected_rows or 0
+    return inserted_count
+
 
+def insert_rows(table_name, rows):
+    """
+    stream rows to a BigQuery table, for rows known not to be in it yet; the table must be one of STREAMED_TABLES
+    :param table_name: one of the GCP_table_* tables
+    :param rows: list of tuples in the order of the table's columns
+    :return: inserted row count
+    """
+    if not rows:
+        return 0
+    bigquery_client = clients.get_client('bigquery')
+    # BigQuery API request
+    errors = bigquery_client.insert_rows(get_table(table_name), rows)
+    if errors:
+        raise Exception(str(errors))
+    return len(rows)
 
-def insert_steps(username, steps, local_timezone=DEFAULT_TIMEZONE):
+
+def pack_nanos(nanos):
+    """
+    :param nanos: list of nanoseconds Unix Epoch time
+    :return: the times as 8 bytes each, to store many of them in one Cloud Datastore blob
+    """
+    return struct.pack('<{}q'.format(len(nanos)), *nanos)
+
+
+def unpack_nanos(packed):
+    """
+    :param packed: bytes from pack_nanos, or None
+    :return: list of nanoseconds Unix Epoch time, None for None
+    """
+    if packed is None:
+        return None
+    return list(struct.unpack('<{}q'.format(len(packed) // 8), packed))
+
+
+def merge_query(table_name, source, columns, update=False):
+    """
+    MERGE statement inserting the source rows not yet in a BigQuery table by the table's MERGE_KEYS
+    :param table_name: one of the GCP_table_* tables
+    :param source: table expression of the incoming rows
+    :param columns: column names of the table
+    :param update: also overwrite the other columns of rows already in the table with the source's values;
+    the source is then reduced to one row per key, as MERGE can update a row from a single source row only
+    :return: standard SQL
+    """
+    keys = MERGE_KEYS[table_name]
+    query = """MERGE `{project}.{dataset}.{table}` T
+USING {source} S
+ON {on}
+WHEN NOT MATCHED THEN
+  INSERT ({columns}) VALUES ({values})"""
+    if update:
+        source = "(SELECT * EXCEPT(row_number) FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY {}) AS row_number " \
+                 "FROM {}) WHERE row_number = 1)".format(', '.join(keys), source)
+        query += """
+WHEN MATCHED THEN
+  UPDATE SET {updates}"""
+    return query.format(
+        project=GCP_project, dataset=GCP_dataset, table=table_name, source=source,
+        on=' AND '.join('T.{0} = S.{0}'.format(key) for key in keys),
+        columns=', '.join(columns), values=', '.join('S.{}'.format(column) for column in columns),
+        updates=', '.join('{0} = S.{0}'.format(column) for column in columns if column not in keys))
+
+
+class LoadJobSink(object):
+    """
+    Collects the rows of every user in a gzip compressed NDJSON file per BigQuery table instead of inserting them
+    user by user. flush loads each file into a staging table with a single load job and MERGEs it into the table,
+    updating the rows already there, so that today's rows can be inserted and completed by a later run. The rows of
+    STREAMED_TABLES are inserted only, as rows in the streaming buffer can't be updated
+    """
+    # rows already in a table are updated, so today's rows are written as well
+    update = True
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.bigquery_client = clients.get_client('bigquery')
+        self._lock = Lock()
+        # per table name: table, temporary file, its gzip stream, usernames written, callbacks after the load
+        self._tables = {}
+        self._files = {}
+        self._gzip_files = {}
+        self._usernames = {}
+        self._callbacks = {}
+
+    def write(self, table_name, username, rows):
+        """
+        add a user's rows to the table's file
+        :param table_name: one of the GCP_table_* tables
+        :param username: user's Gmail
+        :param rows: list of tuples in the order of the table's columns
+        :return: count of rows to be merged into the table
+        """
+        if not rows:
+            return 0
+        with self._lock:
+            if table_name not in self._tables:
+                self._tables[table_name] = get_table(table_name)
+                self._files[table_name] = tempfile.TemporaryFile()
+                self._gzip_files[table_name] = gzip.GzipFile(fileobj=self._files[table_name], mode='wb')
+                self._usernames[table_name] = set()
+            columns = [field.name for field in self._tables[table_name].schema]
+            lines = ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+            self._gzip_files[table_name].write(lines.encode('utf-8'))
+            self._usernames[table_name].add(username)
+        return len(rows)
+
+    def on_loaded(self, table_name, callback):
+        """
+        call back once the table's rows are merged, e.g. to persist a watermark only when its rows are in BigQuery
+        :param table_name: one of the GCP_table_* tables
+        :param callback: function without arguments
+        """
+        with self._lock:
+            self._callbacks.setdefault(table_name, []).append(callback)
+
+    def usernames(self, table_name):
+        """
+        :param table_name: one of the GCP_table_* tables
+        :return: usernames whose rows were written to the table
+        """
+        return self._usernames.get(table_name, set())
+
+    def flush(self):
+        """
+        load every table's file into a staging table and MERGE it into the table
+        :return: dict of table name to error message, for the tables that failed
+        """
+        from google.cloud import bigquery
+        errors = {}
+        for table_name, table in self._tables.items():
+            staging_ref = self.bigquery_client.dataset(GCP_dataset).table(
+                '{}_staging_{}'.format(table_name, self.run_id))
+            try:
+                self._gzip_files[table_name].close()
+                self._files[table_name].seek(0)
+                staging = bigquery.Table(staging_ref, schema=table.schema)
+                # left behind only if the process dies before deleting it
+                staging.expires = datetime.now(pytz.utc) + timedelta(days=1)
+                self.bigquery_client.create_table(staging)
+                job_config = bigquery.LoadJobConfig()
+                job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+                # BigQuery API requests
+                self.bigquery_client.load_table_from_file(self._files[table_name], staging_ref,
+                                                          job_config=job_config).result()
+                self.bigquery_client.query(merge_query(
+                    table_name, '`{}.{}.{}`'.format(GCP_project, GCP_dataset, staging_ref.table_id),
+                    [field.name for field in table.schema], update=table_name not in STREAMED_TABLES)).result()
+                for callback in self._callbacks.get(table_name, []):
+                    callback()
+            except Exception as e:
+                errors[table_name] = 'loading {} failed: {}'.format(table_name, e)
+            finally:
+                self._files[table_name].close()
+                try:
+                    self.bigquery_client.delete_table(staging_ref, not_found_ok=True)
+                except Exception as e:
+                    print('unable to delete staging table {}: {}'.format(staging_ref.table_id, e))
+        return errors
+
+
+class MergeSink(object):
+    """
+    Collects the rows of many users in memory per BigQuery table and merges each table's rows with merge_rows on
+    flush, instead of a MERGE per user and table. Rows already in a table are skipped, like merge_rows does
+    """
+    # rows already in a table are kept, so today's rows, which are still growing, are not written
+    update = False
+
+    def __init__(self):
+        self._lock = Lock()
+        # per table name: rows and usernames written
+        self._rows = {}
+        self._usernames = {}
+
+    def write(self, table_name, username, rows):
+        """
+        add a user's rows to the table's rows
+        :param table_name: one of the GCP_table_* tables
+        :param username: user's Gmail
+        :param rows: list of tuples in the order of the table's columns
+        :return: count of rows to be merged into the table
+        """
+        if not rows:
+            return 0
+        with self._lock:
+            self._rows.setdefault(table_name, []).extend(rows)
+            self._usernames.setdefault(table_name, set()).add(username)
+        return len(rows)
+
+    def usernames(self, table_name):
+        """
+        :param table_name: one of the GCP_table_* tables
+        :return: usernames whose rows were written to the table
+        """
+        return self._usernames.get(table_name, set())
+
+    def flush(self):
+        """
+        MERGE every table's rows into the table and drop them
+        :return: dict of table name to error message, for the tables that failed
+        """
+        errors = {}
+        with self._lock:
+            tables = list(self._rows.items())
+            self._rows.clear()
+        for table_name, rows in tables:
+            try:
+                merge_rows(table_name, rows)
+            except Exception as e:
+                errors[table_name] = 'merging {} failed: {}'.format(table_name, e)
+        return errors
+
+
+def insert_steps(username, steps, local_timezone=DEFAULT_TIMEZONE, sink=None):
     """
     insert step counts to BigQuery except local date of today's steps per local_timezone
     :param username: user's Gmail
     :param steps: dictionary of local date as key, value is another dict of steps, originDataSourceId
     :param local_timezone: timezone such as US/Pacific, one of the pytz.all_timezones
+    :param sink: LoadJobSink or MergeSink to write the rows to instead of merging them now; today's rows are
+    written only if the sink updates them
     :return: inserted row count
     """
-    bigquery_client = bigquery.Client()
-    dataset_ref = bigquery_client.dataset(GCP_dataset)
-    table_steps_ref = dataset_ref.table(GCP_table_steps)
-    table_steps = bigquery_client.get_table(table_steps_ref)
-
-    # check existing rows by local date
-    query = "SELECT DISTINCT recordedLocalDate FROM `{}.{}.{}` WHERE username = '{}' ORDER BY recordedLocalDate DESC ".format(
-        GCP_project, GCP_dataset, GCP_table_steps, username)
-    query_job = bigquery_client.query(query)
-    existing_step_dates = [row['recordedLocalDate'] for row in query_job.result()]
     rows_to_insert = []
     now_utc = datetime.now(pytz.timezone('UTC'))
     now_local = now_utc.astimezone(pytz.timezone(local_timezone))
@@ -300,42 +1023,29 @@ def insert_steps(username, steps, local_timezone=DEFAULT_TIMEZONE):
         incoming_steps_date = datetime.strptime(localDate, DATE_FORMAT).date()
 
         # Do not insert today's steps because error occurs updating or deleting them
-        if incoming_steps_date == now_local.date():
+        if incoming_steps_date == now_local.date() and (sink is None or not sink.update):
             continue
 
-        # if incoming step's date not found in the existing table, insert incoming step count
-        if incoming_steps_date not in existing_step_dates:
-            rows_to_insert.append(
-                (username, localDate, value['steps'], value['originDataSourceId'])
-            )
-
-    if rows_to_insert:
-        # BigQuery API request
-        errors = bigquery_client.insert_rows(table_steps, rows_to_insert)
-        if errors:
-            raise Exception(str(errors))
+        rows_to_insert.append(
+            (username, localDate, value['steps'], value['originDataSourceId'])
+        )
 
-    return len(rows_to_insert)
+    if sink is not None:
+        return sink.write(GCP_table_steps, username, rows_to_insert)
+    # step counts of dates already in the table are skipped by MERGE
+    return merge_rows(GCP_table_steps, rows_to_insert)
 
 
-def insert_calories(username, calories, local_timezone=DEFAULT_TIMEZONE):
+def insert_calories(username, calories, local_timezone=DEFAULT_TIMEZONE, sink=None):
     """
     insert calories to BigQuery except local date of today's calories per local_timezone
     :param username: user's Gmail
     :param calories: dictionary of local date as key, value is another dict of calories, originDataSourceId
     :param local_timezone: timezone such as US/Pacific, one of the pytz.all_timezones
+    :param sink: LoadJobSink or MergeSink to write the rows to instead of merging them now; today's rows are
+    written only if the sink updates them
     :return: inserted row count
     """
-    bigquery_client = bigquery.Client()
-    dataset_ref = bigquery_client.dataset(GCP_dataset)
-    table_calories_ref = dataset_ref.table(GCP_table_calories)
-    table_calories = bigquery_client.get_table(table_calories_ref)
-
-    # check existing rows by local date
-    query = "SELECT DISTINCT recordedLocalDate FROM `{}.{}.{}` WHERE username = '{}' ORDER BY recordedLocalDate DESC ".format(
-        GCP_project, GCP_dataset, GCP_table_calories, username)
-    query_job = bigquery_client.query(query)
-    existing_calories_dates = [row['recordedLocalDate'] for row in query_job.result()]
     rows_to_insert = []
     now_utc = datetime.now(pytz.timezone('UTC'))
     now_local = now_utc.astimezone(pytz.timezone(local_timezone))
@@ -344,44 +1054,29 @@ def insert_calories(username, calories, local_timezone=DEFAULT_TIMEZONE):
         incoming_calories_date = datetime.strptime(localDate, DATE_FORMAT).date()
 
         # Do not insert today's calories because error occurs updating or deleting them
-        if incoming_calories_date == now_local.date():
+        if incoming_calories_date == now_local.date() and (sink is None or not sink.update):
             continue
 
-        # if incoming calory's date not found in the existing table, insert incoming calories
-        if incoming_calories_date not in existing_calories_dates:
-            rows_to_insert.append(
-                (username, localDate, value['calories'], value['originDataSourceId'])
-            )
+        rows_to_insert.append(
+            (username, localDate, value['calories'], value['originDataSourceId'])
+        )
 
-    if rows_to_insert:
-        # BigQuery API request
-        errors = bigquery_client.insert_rows(table_calories, rows_to_insert)
-        if errors:
-            raise Exception(str(errors))
-
-    return len(rows_to_insert)
+    if sink is not None:
+        return sink.write(GCP_table_calories, username, rows_to_insert)
+    # calories of dates already in the table are skipped by MERGE
+    return merge_rows(GCP_table_calories, rows_to_insert)
 
 
-def insert_activities(username, activities, local_timezone=DEFAULT_TIMEZONE):
+def insert_activities(username, activities, local_timezone=DEFAULT_TIMEZONE, sink=None):
     """
     insert activities to BigQuery except local date of today's activities per local_timezone
     :param username: user's Gmail
     :param activities: return from get_activities
     :param local_timezone: timezone such as US/Pacific, one of the pytz.all_timezones
+    :param sink: LoadJobSink or MergeSink to write the rows to instead of merging them now; today's rows are
+    written only if the sink updates them
     :return: inserted counts for 2 tables
     """
-    bigquery_client = bigquery.Client()
-    dataset_ref = bigquery_client.dataset(GCP_dataset)
-    table_activities_ref = dataset_ref.table(GCP_table_activities)
-    table_activities = bigquery_client.get_table(table_activities_ref)
-    table_segments_ref = dataset_ref.table(GCP_table_segments)
-    table_segments = bigquery_client.get_table(table_segments_ref)
-
-    # check existing rows by local date in the table
-    query = "SELECT recordedLocalDate, COUNT(activity_type) AS activity_type_count FROM `{}.{}.{}` WHERE username = '{}' GROUP BY recordedLocalDate ORDER BY recordedLocalDate DESC ".format(
-        GCP_project, GCP_dataset, GCP_table_activities, username)
-    query_job = bigquery_client.query(query)
-    existing_activity_dates = [row['recordedLocalDate'] for row in query_job.result()]
     activity_rows_to_insert = []
     segment_rows_to_insert = []
     now_utc = datetime.now(pytz.timezone('UTC'))
@@ -391,40 +1086,34 @@ def insert_activities(username, activities, local_timezone=DEFAULT_TIMEZONE):
         incoming_activity_date = datetime.strptime(localDate, DATE_FORMAT).date()
 
         # Do not insert today's activities because error occurs updating or deleting them
-        if incoming_activity_date == now_local.date():
+        if incoming_activity_date == now_local.date() and (sink is None or not sink.update):
             continue
 
-        # if incoming activity's date not found in the existing activities table, insert incoming activities
-        if incoming_activity_date not in existing_activity_dates:
-            for daily_activity in value['daily_activities']:
-                activity_rows_to_insert.append(
-                    (username, localDate, daily_activity['activity_type'], daily_activity['seconds'],
-                     daily_activity['segments'])
-                )
-            # insert activity segments
-            for point in value['activity_dataset']['point']:
-                activity_type = point['value'][0]['intVal']
-                segment_rows_to_insert.append(
-                    (username, localDate, activity_type, point['startTimeNanos'], point['endTimeNanos'],
-                     point['originDataSourceId'])
-                )
-    if activity_rows_to_insert:
-        # BigQuery API request
-        errors = bigquery_client.insert_rows(table_activities, activity_rows_to_insert)
-        if errors:
-            raise Exception(str(errors))
-    if segment_rows_to_insert:
-        # BigQuery API request
-        errors = bigquery_client.insert_rows(table_segments, segment_rows_to_insert)
-        if errors:
-            raise Exception(str(errors))
+        for daily_activity in value['daily_activities']:
+            activity_rows_to_insert.append(
+                (username, localDate, daily_activity['activity_type'], daily_activity['seconds'],
+                 daily_activity['segments'])
+            )
+        # insert activity segments
+        for point in value['activity_dataset']['point']:
+            activity_type = point['value'][0]['intVal']
+            segment_rows_to_insert.append(
+                (username, localDate, activity_type, point['startTimeNanos'], point['endTimeNanos'],
+                 point['originDataSourceId'])
+            )
 
-    return {'inserted_activity_count': len(activity_rows_to_insert),
-            'inserted_segment_count': len(segment_rows_to_insert)}
+    if sink is not None:
+        return {'inserted_activity_count': sink.write(GCP_table_activities, username, activity_rows_to_insert),
+                'inserted_segment_count': sink.write(GCP_table_segments, username, segment_rows_to_insert)}
+    # activities and segments already in the tables are skipped by MERGE
+    return {'inserted_activity_count': merge_rows(GCP_table_activities, activity_rows_to_insert),
+            'inserted_segment_count': merge_rows(GCP_table_segments, segment_rows_to_insert)}
 
 
 class UserDataFlow:
-    def __init__(self, username, http_auth, start_year, start_month, start_day, end_time_millis, local_timezone):
+    def __init__(self, username, http_auth, start_year, start_month, start_day, end_time_millis, local_timezone,
+                 kinds=BUNDLE_KINDS, heart_rate_watermark=None, heart_rate_overlap=None, sink=None,
+                 merge_sink=None):
         self.username = username
         self.http_auth = http_auth
         self.start_year = start_year
@@ -432,45 +1121,97 @@ class UserDataFlow:
         self.start_day = start_day
         self.end_time_millis = end_time_millis
         self.local_timezone = local_timezone
+        # kinds fetched together by one aggregate request; None until get_bundle succeeds
+        self.kinds = kinds
+        self.bundle = None
+        # latest heart rate recordedTimeNanos in BigQuery, advanced by get_and_post_heart_rate
+        self.heart_rate_watermark = heart_rate_watermark
+        # heart rate recordedTimeNanos in BigQuery from HEART_RATE_OVERLAP_HOURS before the watermark on, or None
+        self.heart_rate_overlap = heart_rate_overlap
+        # LoadJobSink collecting the rows of many users, None to insert each user's rows right away
+        self.sink = sink
+        # MergeSink collecting the steps, calories and activities of many users without a LoadJobSink; the heart rate
+        # rows are still inserted right away, skipping the overlap before the watermark
+        self.merge_sink = merge_sink
+
+    def get_bundle(self):
+        """
+        fetch every kind's aggregate in one Google Fitness API round trip; the get_* methods fall back to
+        a request of their own when the bundle could not be fetched, e.g. a data source missing for the user
+        """
+        try:
+            self.bundle = get_daily_bundle(self.http_auth, self.start_year, self.start_month, self.start_day,
+                                           self.end_time_millis, self.local_timezone, self.kinds)
+        except googleapiclient.errors.HttpError as err:
+            if err.resp.status not in (400, 403, 404):
+                raise
+            print('bundled aggregate failed for user {}, getting each kind separately: {}'.format(self.username,
+                                                                                                   err))
+            self.bundle = {}
+        return self.bundle
+
+    def _bundled(self, kind):
+        if self.bundle is None:
+            self.get_bundle()
+        return self.bundle.get(kind)
 
     def get_steps(self):
-        self.steps = get_daily_steps(self.http_auth, self.start_year, self.start_month, self.start_day,
-                                     self.end_time_millis, self.local_timezone)
+        self.steps = self._bundled('steps')
+        if self.steps is None:
+            self.steps = get_daily_steps(self.http_auth, self.start_year, self.start_month, self.start_day,
+                                         self.end_time_millis, self.local_timezone)
         return self.steps
 
     def post_steps(self):
         if self.steps is not None:
-            self.insert_steps_result = insert_steps(self.username, self.steps, self.local_timezone)
+            self.insert_steps_result = insert_steps(self.username, self.steps, self.local_timezone,
+                                                    self.sink or self.merge_sink)
             return self.insert_steps_result
         else:
             raise RuntimeError('no self.steps to insert to BigQuery')
 
     def get_calories(self):
-        self.calories = get_daily_calories(self.http_auth, self.start_year, self.start_month, self.start_day,
-                                     self.end_time_millis, self.local_timezone)
+        self.calories = self._bundled('calories')
+        if self.calories is None:
+            self.calories = get_daily_calories(self.http_auth, self.start_year, self.start_month, self.start_day,
+                                               self.end_time_millis, self.local_timezone)
         return self.calories
 
     def post_calories(self):
         if self.calories is not None:
-            self.insert_calories_result = insert_calories(self.username, self.calories, self.local_timezone)
+            self.insert_calories_result = insert_calories(self.username, self.calories, self.local_timezone,
+                                                          self.sink or self.merge_sink)
             return self.insert_calories_result
         else:
             raise RuntimeError('no self.calories to insert to BigQuery')
 
-    def get_and_post_heart_rate(self):
+    def get_and_post_heart_rate(self, archive=None):
         self.insert_heart_rate_result = get_and_insert_heart_rate(self.http_auth, self.username, self.start_year,
                                                                   self.start_month, self.start_day,
-                                                                  self.end_time_millis, self.local_timezone)
+                                                                  self.end_time_millis, self.local_timezone,
+                                                                  heartrate_data=self._bundled('heartrate'),
+                                                                  watermark_nanos=self.heart_rate_watermark,
+                                                                  overlap_nanos=self.heart_rate_overlap,
+                                                                  sink=self.sink, archive=archive,
+                                                                  on_flush=self._advance_heart_rate_watermark)
         return self.insert_heart_rate_result
 
+    def _advance_heart_rate_watermark(self, watermark_nanos, overlap_nanos):
+        # a retry after a failed chunk skips the chunks already inserted
+        self.heart_rate_watermark = watermark_nanos
+        self.heart_rate_overlap = overlap_nanos
+
     def get_activities(self):
-        self.activities = get_daily_activities(self.http_auth, self.start_year, self.start_month, self.start_day,
-                                               self.end_time_millis, self.local_timezone)
+        self.activities = self._bundled('activities')
+        if self.activities is None:
+            self.activities = get_daily_activities(self.http_auth, self.start_year, self.start_month,
+                                                   self.start_day, self.end_time_millis, self.local_timezone)
         return self.activities
 
     def post_activities(self):
         if self.activities is not None:
-            self.insert_activities_result = insert_activities(self.username, self.activities, self.local_timezone)
+            self.insert_activities_result = insert_activities(self.username, self.activities, self.local_timezone,
+                                                              self.sink or self.merge_sink)
             return self.insert_activities_result
         else:
             raise RuntimeError('no self.activities to insert to BigQuery')
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+import hashlib
+import json
+import sys
+import time
+import traceback
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+from threading import Event, Thread
+
+import backend
+import clients
+from pool import run_in_pool
+
+# kinds of data a backfill gets and inserts, in the order of a user's windows
+BACKFILL_KINDS = ('steps', 'calories', 'activities', 'heartrate')
+# Cloud Datastore kind of a completed window, a child of its job's entity
+WINDOW_KIND = 'backfill_window'
+# most window errors kept in a job's entity
+MAX_JOB_ERRORS = 100
+
+# local dates [start, end) of one kind of a user's data, fetched and inserted as a unit
+Window = namedtuple('Window', ['username', 'kind', 'start', 'end'])
+
+
+def window_name(window):
+    return '{}|{}|{}'.format(window.username, window.kind, window.start.strftime(backend.DATE_FORMAT))
+
+
+def make_job_id(usernames, start, end, kinds):
+    """
+    :return: id of the job of the arguments, the same for every request of them so that a request resumes it
+    """
+    key = json.dumps([sorted(set(usernames)), start.strftime(backend.DATE_FORMAT),
+                      end.strftime(backend.DATE_FORMAT), sorted(set(kinds))])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def split_windows(usernames, start, end, kinds, window_days=backend.BACKFILL_WINDOW_DAYS):
+    """
+    split [start, end) into windows of window_days for every user and kind. Windows are ordered by date, then user,
+    so that the threads running them spread over the users
+    :param usernames: list of users' Gmail
+    :param start: first local date
+    :param end: local date after the last one
+    :param kinds: any of BACKFILL_KINDS
+    :param window_days: days of a window at most
+    :return: list of Window
+    """
+    windows = []
+    day = start
+    while day < end:
+        window_end = min(end, day + timedelta(days=window_days))
+        for username in usernames:
+            for kind in kinds:
+                windows.append(Window(username, kind, day, window_end))
+        day = window_end
+    return windows
+
+
+def run_window(window, get_user, on_heart_rate=None):
+    """
+    get and insert a window's data. Rows already in BigQuery are skipped, so a window is safe to run again
+    :param window: Window
+    :param get_user: function of username returning the user's authenticated HTTP client and timezone
+    :param on_heart_rate: optional function of username, the latest heart rate recordedTimeNanos inserted and the
+    ones of the overlap before it, called even when the window fails after inserting some rows
+    """
+    http_auth, timezone = get_user(window.username)
+    end_time_millis = backend.local_start_millis(window.end.year, window.end.month, window.end.day, timezone)
+    # without a watermark, heart rate data older than the latest inserted is MERGEd as well
+    df = backend.UserDataFlow(window.username, http_auth, window.start.year, window.start.month, window.start.day,
+                              end_time_millis, timezone, kinds=(window.kind,))
+    if window.kind == 'heartrate':
+        # the datasets are not kept, bounding the memory of a window
+        try:
+            df.get_and_post_heart_rate(archive=lambda day, dataset: None)
+        finally:
+            if on_heart_rate is not None:
+                on_heart_rate(window.username, df.heart_rate_watermark, df.heart_rate_overlap)
+    else:
+        getattr(df, 'get_' + window.kind)()
+        getattr(df, 'post_' + window.kind)()
+
+
+def completed_windows(job_id):
+    """
+    :return: names of the job's windows checkpointed in Cloud Datastore
+    """
+    ds = clients.get_client('datastore')
+    query = ds.query(kind=WINDOW_KIND, ancestor=ds.key(backend.BACKFILL_KIND, job_id))
+    query.keys_only()
+    return set(key.key.id_or_name for key in query.fetch())
+
+
+class LeaseLost(Exception):
+    """
+    another process has taken over the lease of the job
+    """
+
+
+def save_job(job_id, owner=None, **properties):
+    """
+    create or update the job's entity in Cloud Datastore
+    :param job_id: id from make_job_id
+    :param owner: optional id of the runner; the job is then updated only while the runner holds its lease
+    :param properties: properties to set
+    :return: whether the job was updated
+    """
+    from google.cloud import datastore
+    ds = clients.get_client('datastore')
+    key = ds.key(backend.BACKFILL_KIND, job_id)
+    with ds.transaction():
+        job = ds.get(key) or datastore.Entity(key=key, exclude_from_indexes=('usernames', 'errors'))
+        if owner is not None and job.get('owner') != owner:
+            return False
+        job.update(properties)
+        job['updated'] = datetime.utcnow()
+        ds.put(job)
+    return True
+
+
+def claim_job(job_id, owner, **properties):
+    """
+    claim or renew the lease of a job in a Cloud Datastore transaction, unless another runner holds an unexpired
+    lease on it, so that a job runs in one process at a time
+    :param job_id: id from make_job_id
+    :param owner: id of the runner
+    :param properties: properties to set along with the lease
+    :return: whether the lease is the owner's
+    """
+    from google.cloud import datastore
+    ds = clients.get_client('datastore')
+    key = ds.key(backend.BACKFILL_KIND, job_id)
+    with ds.transaction():
+        job = ds.get(key)
+        if job is not None and job.get('owner') not in (None, owner) and job.get('lease_until', 0) > time.time():
+            return False
+        if job is None:
+            job = datastore.Entity(key=key, exclude_from_indexes=('usernames', 'errors'))
+        job.update(properties)
+        job['owner'] = owner
+        job['lease_until'] = time.time() + backend.BACKFILL_LEASE
+        job['updated'] = datetime.utcnow()
+        ds.put(job)
+    return True
+
+
+def release_job(job_id, owner):
+    """
+    give up the owner's lease of a job, unless another runner has taken it over
+    """
+    ds = clients.get_client('datastore')
+    with ds.transaction():
+        job = ds.get(ds.key(backend.BACKFILL_KIND, job_id))
+        if job is not None and job.get('owner') == owner:
+            job['owner'] = None
+            job['lease_until'] = 0
+            ds.put(job)
+
+
+def run_job(job_id, usernames, start, end, kinds, get_user, policy, on_heart_rate=None,
+            pool_size=backend.BACKFILL_POOL_SIZE, semaphore=None, owner=None, lost=None):
+    """
+    run the windows of a job that are not checkpointed yet on a pool of threads, checkpointing each one
+    in Cloud Datastore once its rows are inserted
+    :param job_id: id from make_job_id
+    :param usernames: list of users' Gmail
+    :param start: first local date
+    :param end: local date after the last one
+    :param kinds: any of BACKFILL_KINDS
+    :param get_user: function of username returning the user's authenticated HTTP client and timezone
+    :param policy: RetryPolicy of a window's attempts; its category is the window's kind
+    :param on_heart_rate: optional function of username, the latest heart rate recordedTimeNanos inserted and the
+    ones of the overlap before it
+    :param pool_size: number of threads
+    :param semaphore: optional threading semaphore held while a window runs, to cap concurrent work across pools
+    :param owner: optional id of the runner holding the job's lease, see claim_job
+    :param lost: optional threading Event set once the lease is lost; no window starts after it
+    :return: list of (window, exception) of the windows that failed
+    """
+    from google.cloud import datastore
+    ds = clients.get_client('datastore')
+    job_key = ds.key(backend.BACKFILL_KIND, job_id)
+    windows = split_windows(usernames, start, end, kinds)
+    done = completed_windows(job_id)
+    todo = [window for window in windows if window_name(window) not in done]
+    print('backfill {}: {} of {} windows to run'.format(job_id, len(todo), len(windows)))
+    save_job(job_id, owner, status='running', windows=len(windows), errors=[])
+
+    def run_and_checkpoint(window):
+        if lost is not None and lost.is_set():
+            raise LeaseLost(job_id)
+        policy.call(window.kind, lambda: run_window(window, get_user, on_heart_rate))
+        checkpoint = datastore.Entity(key=ds.key(WINDOW_KIND, window_name(window), parent=job_key))
+        checkpoint.update({
+            'username': window.username,
+            'kind': window.kind,
+            'start': window.start.strftime(backend.DATE_FORMAT),
+            'end': window.end.strftime(backend.DATE_FORMAT),
+            'finished': datetime.utcnow(),
+        })
+        ds.put(checkpoint)
+
+    failures = run_in_pool(run_and_checkpoint, todo, pool_size, semaphore=semaphore)
+    errors = ['{}: {}'.format(window_name(window), err) for window, err in failures[:MAX_JOB_ERRORS]]
+    if lost is None or not lost.is_set():
+        save_job(job_id, owner, status='failed' if failures else 'done', errors=errors)
+    return failures
+
+
+def start_job(usernames, start, end, kinds, get_user, policy, on_heart_rate=None, semaphore=None):
+    """
+    run a job on a background thread, unless a process holds its lease. The lease is renewed while the job runs;
+    a job that was interrupted, e.g. by a restart, resumes from its checkpoints when started again
+    :return: job id, whether the job was started
+    """
+    job_id = make_job_id(usernames, start, end, kinds)
+    owner = uuid.uuid4().hex
+    if not claim_job(job_id, owner, status='queued', usernames=sorted(set(usernames)), kinds=sorted(set(kinds)),
+                     start=start.strftime(backend.DATE_FORMAT), end=end.strftime(backend.DATE_FORMAT),
+                     created=datetime.utcnow()):
+        return job_id, False
+    stopped = Event()
+    lost = Event()
+
+    def renew_lease():
+        while not stopped.wait(backend.BACKFILL_LEASE / 3.0):
+            try:
+                if not claim_job(job_id, owner):
+                    print('backfill {} lost its lease, stopping'.format(job_id))
+                    lost.set()
+                    return
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+    def run():
+        renewer = Thread(target=renew_lease)
+        renewer.daemon = True
+        renewer.start()
+        try:
+            run_job(job_id, sorted(set(usernames)), start, end, kinds, get_user, policy, on_heart_rate,
+                    semaphore=semaphore, owner=owner, lost=lost)
+        except Exception as e:
+            print('backfill {} failed: {}'.format(job_id, e))
+            if not lost.is_set():
+                save_job(job_id, owner, status='failed', errors=[str(e)])
+        finally:
+            stopped.set()
+            renewer.join()
+            if not lost.is_set():
+                release_job(job_id, owner)
+
+    t = Thread(target=run)
+    t.daemon = True
+    t.start()
+    return job_id, True
+
+
+def get_job_status(job_id):
+    """
+    :param job_id: id from make_job_id
+    :return: dict of the job's properties and its count of completed windows, None if there is no such job.
+    A queued or running job whose lease has expired, e.g. as its process died, is interrupted
+    """
+    ds = clients.get_client('datastore')
+    job = ds.get(ds.key(backend.BACKFILL_KIND, job_id))
+    if job is None:
+        return None
+    status = dict(job.items())
+    if status.get('status') in ('queued', 'running') and status.get('lease_until', 0) < time.time():
+        status['status'] = 'interrupted'
+    status.pop('owner', None)
+    for name in ('created', 'updated'):
+        if status.get(name) is not None:
+            status[name] = status[name].strftime('%Y-%m-%d %H:%M:%S')
+    status['job_id'] = job_id
+    status['completed'] = len(completed_windows(job_id))
+    return status
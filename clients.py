@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+import json
+import os
+import sys
+from importlib import import_module
+from threading import Lock
+
+import httplib2
+from googleapiclient.discovery import DISCOVERY_URI, build_from_document
+from googleapiclient.errors import HttpError
+
+# discovery documents shipped with the app, see load_discovery_document
+if 'DISCOVERY_DIR' in os.environ:
+    DISCOVERY_DIR = os.environ['DISCOVERY_DIR']
+else:
+    DISCOVERY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'discovery')
+
+_services = {}
+_services_lock = Lock()
+
+# Google Cloud client libraries by client name, imported when their client is first needed
+CLOUD_CLIENT_MODULES = {
+    'bigquery': 'google.cloud.bigquery',
+    'datastore': 'google.cloud.datastore',
+    'storage': 'google.cloud.storage',
+    'error_reporting': 'google.cloud.error_reporting',
+}
+# APIs whose services warm builds
+WARM_SERVICES = (('fitness', 'v1'), ('oauth2', 'v2'))
+_cloud_clients = {}
+_cloud_clients_pid = None
+_cloud_clients_lock = Lock()
+
+
+def get_client(name):
+    """
+    get a Google Cloud client created once per process and shared by its threads, e.g. get_client('bigquery').
+    A forked process creates its own clients, as their connections can't be shared with the parent
+    :param name: one of CLOUD_CLIENT_MODULES
+    :return: the library's Client
+    """
+    global _cloud_clients_pid
+    pid = os.getpid()
+    cloud_client = _cloud_clients.get(name) if _cloud_clients_pid == pid else None
+    if cloud_client is None:
+        with _cloud_clients_lock:
+            if _cloud_clients_pid != pid:
+                _cloud_clients.clear()
+                _cloud_clients_pid = pid
+            cloud_client = _cloud_clients.get(name)
+            if cloud_client is None:
+                cloud_client = import_module(CLOUD_CLIENT_MODULES[name]).Client()
+                _cloud_clients[name] = cloud_client
+    return cloud_client
+
+
+def warm():
+    """
+    import the Google Cloud client libraries and build the API services ahead of the first request, e.g. in the
+    gunicorn master before it forks the workers with preload_app. The clients are still created in each worker
+    """
+    for module in CLOUD_CLIENT_MODULES.values():
+        import_module(module)
+    for api, version in WARM_SERVICES:
+        get_service(api, version)
+
+
+def enable_debugger():
+    """
+    enable Google Cloud Stackdriver Debugger https://cloud.google.com/debugger/docs/setup/python in this process;
+    its agent does not survive a fork, so call it in each worker
+    """
+    try:
+        import googleclouddebugger
+
+        googleclouddebugger.enable()
+        print("Google Cloud Debugger enabled")
+    except ImportError as e:
+        sys.stderr.write("Failed to load Google Cloud Debugger: {}\n".format(e))
+
+
+def get_service(api, version):
+    """
+    get a Google API service built once per process. The service is not bound to any user, so pass the user's
+    authenticated HTTP client when executing a request, e.g.
+    get_service('fitness', 'v1').users().dataSources().list(userId="me").execute(http=http_auth)
+    :param api: API name such as fitness
+    :param version: API version such as v1
+    :return: googleapiclient Resource shared by every thread of the process
+    """
+    key = (api, version)
+    service = _services.get(key)
+    if service is None:
+        with _services_lock:
+            service = _services.get(key)
+            if service is None:
+                # the unauthenticated http is never used as every request is executed with the user's http
+                service = build_from_document(load_discovery_document(api, version), http=httplib2.Http())
+                _services[key] = service
+    return service
+
+
+def load_discovery_document(api, version):
+    """
+    load an API's discovery document from DISCOVERY_DIR, or fetch it if it is missing there. The fetched document is
+    not saved, as the app's directory is read only once deployed; commit it to DISCOVERY_DIR instead
+    :param api: API name such as fitness
+    :param version: API version such as v1
+    :return: parsed discovery document
+    """
+    path = os.path.join(DISCOVERY_DIR, '{}.{}.json'.format(api, version))
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+
+    uri = DISCOVERY_URI.format(api=api, apiVersion=version)
+    print('discovery document {} is missing, fetching {}'.format(path, uri))
+    resp, content = httplib2.Http().request(uri)
+    if resp.status >= 400:
+        raise HttpError(resp, content, uri=uri)
+    return json.loads(content.decode('utf-8'))
@@ -1,31 +1,55 @@
 #!/usr/bin/env python
-import json
-from threading import Thread
+import time
+from collections import OrderedDict
+from functools import partial
+from threading import BoundedSemaphore, Lock, Thread
 
 import googleapiclient.errors
 import httplib2
 import pytz
 from bottle import *
-from google.cloud import datastore
-from google.cloud import error_reporting
-from google.cloud import storage
-from googleapiclient.discovery import build
 from oauth2client import client
 
 import backend
+import backfill
+import clients
+import responses
+from archive import ArchiveWriter, NdjsonArchive
+from pool import run_in_pool
+from retry import CircuitBreaker, RetryBudget, RetryPolicy
 
 # bottle web framework init
 app = Bottle()
 application = app
-
-# Google Cloud Stackdriver Debugger https://cloud.google.com/debugger/docs/setup/python
-try:
-    import googleclouddebugger
-
-    googleclouddebugger.enable()
-    print("Google Cloud Debugger enabled")
-except ImportError as e:
-    print >> sys.stderr, "Failed to load Google Cloud Debugger for Python 2: ".format(e)
+responses.install(app)
+
+# username to the user's credentials, timezone and cache expiry time; see get_google_http_auth_n_user_timezone
+_credentials_cache = {}
+_credentials_cache_lock = Lock()
+
+# Cloud Datastore property of the user's latest heart rate recordedTimeNanos in BigQuery
+HEART_RATE_WATERMARK = 'heart_rate_watermark_nanos'
+# Cloud Datastore blob of the heart rate recordedTimeNanos in BigQuery from backend.HEART_RATE_OVERLAP_HOURS before
+# the watermark on, see backend.pack_nanos; missing while unknown
+HEART_RATE_OVERLAP = 'heart_rate_overlap_nanos'
+# most keys of a Cloud Datastore lookup
+DATASTORE_GET_MULTI_KEYS = 1000
+# most entities written by a Cloud Datastore commit
+DATASTORE_PUT_MULTI_ENTITIES = 500
+
+# category of the cron results that a failed LoadJobSink table is reported in
+SINK_CATEGORIES = {
+    backend.GCP_table_heartrate: 'heartrate',
+    backend.GCP_table_activities: 'activities',
+    backend.GCP_table_segments: 'activities',
+    backend.GCP_table_steps: 'steps',
+    backend.GCP_table_calories: 'calories',
+}
+
+# caps the users processed at once across all insert_daily_fitness requests of this process
+_fit_concurrency = BoundedSemaphore(backend.FIT_MAX_CONCURRENCY)
+# pauses every insert_daily_fitness thread of this process while the project's Google Fitness API quota is exhausted
+_quota_breaker = CircuitBreaker()
 
 
 @app.get('/')
@@ -39,21 +63,16 @@ def oauth2callback():
     redirect_uri = "{}://{}{}".format(urlparts.scheme, urlparts.netloc, urlparts.path)
     timezone = request.query.get('state', None)
 
-    flow = client.flow_from_clientsecrets(
-        backend.client_secret_file,
-        scope=["profile", "email", 'https://www.googleapis.com/auth/fitness.activity.read',
-               'https://www.googleapis.com/auth/fitness.body.read'],
-        redirect_uri=redirect_uri)
-    flow.params['access_type'] = 'offline'
-    flow.params['prompt'] = 'consent'
+    flow = backend.make_oauth_flow(redirect_uri)
     creds = flow.step2_exchange(code=request.query.code)
     http_auth = creds.authorize(httplib2.Http())
-    user_info_service = build('oauth2', 'v2', http=http_auth)
+    user_info_service = clients.get_service('oauth2', 'v2')
     get_user_task = user_info_service.userinfo().get()
-    ds = datastore.Client()
-    u = get_user_task.execute()
+    ds = clients.get_client('datastore')
+    u = get_user_task.execute(http=http_auth)
 
     # insert to Cloud Datastore
+    from google.cloud import datastore
     entity = datastore.Entity(key=ds.key(backend.DATASTORE_KIND, u['email']))
     now = datetime.utcnow()
     entity.update({
@@ -69,7 +88,7 @@ def oauth2callback():
 
     # required to serialize entity
     entity['last_updated'] = now.strftime('%Y-%m-%d %H:%M:%S %Z')
-    return json.dumps(entity.items())
+    return responses.json_body(list(entity.items()))
 
 
 @app.post('/v1/users/<username>/steps')
@@ -116,6 +135,7 @@ def get_steps(username):
             response.content_type = 'application/json'
             return steps
         except client.HttpAccessTokenRefreshError as err:
+            evict_user_credentials(username)
             return HTTPError(httplib.UNAUTHORIZED, "Refresh token invalid: " + str(err))
         except googleapiclient.errors.HttpError as err:
             return HTTPError(err.resp.status, "Google API HttpError: " + str(err))
@@ -147,6 +167,7 @@ def get_calories(username):
             response.content_type = 'application/json'
             return calories
         except client.HttpAccessTokenRefreshError as err:
+            evict_user_credentials(username)
             return HTTPError(httplib.UNAUTHORIZED, "Refresh token invalid: " + str(err))
         except googleapiclient.errors.HttpError as err:
             return HTTPError(err.resp.status, "Google API HttpError: " + str(err))
@@ -180,13 +201,7 @@ def google_auth():
     parts = request.urlparts
     redirect_uri = "{}://{}/oauth2callback".format(parts.scheme, parts.netloc)
 
-    flow = client.flow_from_clientsecrets(
-        backend.client_secret_file,
-        scope=["profile", "email", 'https://www.googleapis.com/auth/fitness.activity.read',
-               'https://www.googleapis.com/auth/fitness.body.read'],
-        redirect_uri=redirect_uri)
-    flow.params['access_type'] = 'offline'
-    flow.params['prompt'] = 'consent'
+    flow = backend.make_oauth_flow(redirect_uri)
     error = check_forms_apikey()
     if error:
         return error
@@ -249,6 +264,7 @@ def get_user_activities(username):
             response.content_type = 'application/json'
             return activities
         except client.HttpAccessTokenRefreshError as err:
+            evict_user_credentials(username)
             return HTTPError(httplib.UNAUTHORIZED, "Refresh token invalid: " + str(err))
         except googleapiclient.errors.HttpError as err:
             return HTTPError(err.resp.status, "Google API HttpError: " + str(err))
@@ -290,11 +306,12 @@ def list_all_datasources(username):
     try:
         datasources = backend.list_datasources(http_auth)
     except client.HttpAccessTokenRefreshError as err:
+        evict_user_credentials(username)
         return HTTPError(httplib.UNAUTHORIZED, "Refresh token invalid: " + str(err))
     except googleapiclient.errors.HttpError as err:
         return HTTPError(err.resp.status, "Google API HttpError: " + str(err))
 
-    return json.dumps(datasources)
+    return responses.json_body(datasources)
 
 
 @app.post('/v1/users/<username>/heart')
@@ -318,31 +335,183 @@ def insert_heart_rate(username):
             if end_time_millis is None:
                 end_time_millis = backend.current_milli_time()
 
+            # ignore_watermark in headers backfills data older than the latest heart rate inserted
+            watermark_nanos, overlap_nanos = None, None
+            if request.headers.get('ignore_watermark', '').lower() not in ('true', '1'):
+                watermark_nanos, overlap_nanos = get_heart_rate_watermark(username)
             result = backend.get_and_insert_heart_rate(http_auth, username, start_date['year'], start_date['month'],
-                                                       start_date['day'], end_time_millis, local_timezone=timezone)
+                                                       start_date['day'], end_time_millis, local_timezone=timezone,
+                                                       watermark_nanos=watermark_nanos, overlap_nanos=overlap_nanos,
+                                                       on_flush=partial(set_heart_rate_watermark, username))
             response.content_type = 'application/json'
             return result
         except client.HttpAccessTokenRefreshError as err:
+            evict_user_credentials(username)
             return HTTPError(httplib.UNAUTHORIZED, "Refresh token invalid: " + str(err))
         except googleapiclient.errors.HttpError as err:
             return HTTPError(err.resp.status, "Google API HttpError: " + str(err))
 
 
 def get_google_http_auth_n_user_timezone(username):
-    with open(backend.client_secret_file) as f:
-        client_secret_json = json.load(f)
-        client_id = client_secret_json['web']['client_id']
-        client_secret = client_secret_json['web']['client_secret']
-    ds = datastore.Client()
-    key = ds.key('credentials', username)
-    user = ds.get(key)
-    assert user.key.id_or_name == username
-    refresh_token = user['refresh_token']
-    timezone = user['timezone']
-    creds = client.GoogleCredentials(None, client_id, client_secret, refresh_token, None,
-                                     "https://accounts.google.com/o/oauth2/token", "Python")
-    http_auth = creds.authorize(httplib2.Http())
-    return http_auth, timezone
+    """
+    authorize an HTTP client as the user with the refresh token from Cloud Datastore. The user's profile is
+    cached for backend.CREDENTIALS_CACHE_TTL seconds, so their access token is reused until it expires
+    :param username: user's Gmail
+    :return: user authenticated HTTP client, user's timezone
+    """
+    with _credentials_cache_lock:
+        cached = _credentials_cache.get(username)
+    if cached is None or cached['expires_at'] <= time.time():
+        ds = clients.get_client('datastore')
+        user = ds.get(ds.key(backend.DATASTORE_KIND, username))
+        assert user.key.id_or_name == username
+        cached = cache_user_profile(user)
+    # httplib2.Http is not thread-safe, so every caller gets its own
+    http_auth = cached['credentials'].authorize(httplib2.Http())
+    return http_auth, cached['timezone']
+
+
+def cache_user_profile(user):
+    """
+    cache the credentials and timezone of a user entity for get_google_http_auth_n_user_timezone. Credentials
+    cached with the same refresh token are kept, along with their access token
+    :param user: Cloud Datastore entity of backend.DATASTORE_KIND
+    :return: profile of credentials, timezone, heart_rate_watermark, heart_rate_overlap and expires_at
+    """
+    with _credentials_cache_lock:
+        cached = _credentials_cache.get(user.key.id_or_name)
+    if cached is not None and cached['credentials'].refresh_token == user['refresh_token']:
+        creds = cached['credentials']
+    else:
+        client_id, client_secret = backend.load_client_secret()
+        creds = client.GoogleCredentials(None, client_id, client_secret, user['refresh_token'], None,
+                                         "https://accounts.google.com/o/oauth2/token", "Python")
+    profile = {
+        'credentials': creds,
+        'timezone': user['timezone'],
+        'heart_rate_watermark': user.get(HEART_RATE_WATERMARK),
+        # packed, unpacked by new_daily_flow
+        'heart_rate_overlap': user.get(HEART_RATE_OVERLAP),
+        'expires_at': time.time() + backend.CREDENTIALS_CACHE_TTL,
+    }
+    with _credentials_cache_lock:
+        _credentials_cache[user.key.id_or_name] = profile
+    return profile
+
+
+def load_user_profiles(usernames=None, failures=None):
+    """
+    read many users from Cloud Datastore at once: every user with one paginated query, or the given users with
+    get_multi batches. Their profiles are cached as well
+    :param usernames: list of users' Gmail; None for every user
+    :param failures: optional list to append (username, exception) to for each user whose entity is invalid,
+    e.g. without a refresh_token
+    :return: OrderedDict of username to profile, see cache_user_profile; users missing in Cloud Datastore and users
+    of failures are left out
+    """
+    ds = clients.get_client('datastore')
+    profiles = OrderedDict()
+
+    def add_profile(user, found):
+        try:
+            found[user.key.id_or_name] = cache_user_profile(user)
+        except Exception as e:
+            print('invalid Cloud Datastore entity of user {}: {!r}'.format(user.key.id_or_name, e))
+            if failures is not None:
+                failures.append((user.key.id_or_name, e))
+
+    if usernames is None:
+        for user in ds.query(kind=backend.DATASTORE_KIND).fetch():
+            add_profile(user, profiles)
+        return profiles
+    usernames = list(OrderedDict.fromkeys(usernames))
+    found = {}
+    for i in range(0, len(usernames), DATASTORE_GET_MULTI_KEYS):
+        keys = [ds.key(backend.DATASTORE_KIND, username) for username in usernames[i:i + DATASTORE_GET_MULTI_KEYS]]
+        for user in ds.get_multi(keys):
+            add_profile(user, found)
+    for username in usernames:
+        if username in found:
+            profiles[username] = found[username]
+    return profiles
+
+
+def get_heart_rate_watermark(username):
+    """
+    get the latest heart rate recordedTimeNanos inserted to BigQuery for the user, and the ones of the overlap
+    before it
+    :param username: user's Gmail
+    :return: nanoseconds Unix Epoch time and list of them, each None if unknown
+    """
+    ds = clients.get_client('datastore')
+    user = ds.get(ds.key(backend.DATASTORE_KIND, username))
+    if user is None:
+        return None, None
+    return user.get(HEART_RATE_WATERMARK), backend.unpack_nanos(user.get(HEART_RATE_OVERLAP))
+
+
+def set_heart_rate_watermark(username, watermark_nanos, overlap_nanos=None):
+    """
+    store the latest heart rate recordedTimeNanos inserted to BigQuery next to the user's credentials, with the
+    ones of the overlap before it, see advance_heart_rate_watermark
+    :param username: user's Gmail
+    :param watermark_nanos: nanoseconds Unix Epoch time
+    :param overlap_nanos: list of nanoseconds Unix Epoch time from get_and_insert_heart_rate, None if unknown
+    """
+    set_heart_rate_watermarks({username: (watermark_nanos, overlap_nanos)})
+
+
+def set_heart_rate_watermarks(watermarks):
+    """
+    store many users' heart rate watermarks with a transaction per DATASTORE_PUT_MULTI_ENTITIES users, instead of
+    one per user
+    :param watermarks: dict of username to the watermark and overlap of set_heart_rate_watermark
+    """
+    watermarks = dict((username, value) for username, value in watermarks.items() if value[0] is not None)
+    ds = clients.get_client('datastore')
+    usernames = sorted(watermarks)
+    for i in range(0, len(usernames), DATASTORE_PUT_MULTI_ENTITIES):
+        keys = [ds.key(backend.DATASTORE_KIND, username) for username in usernames[i:i + DATASTORE_PUT_MULTI_ENTITIES]]
+        # read in the transaction, so that e.g. a refresh token saved meanwhile by oauth2callback is kept
+        with ds.transaction():
+            users = [user for user in ds.get_multi(keys)
+                     if advance_heart_rate_watermark(user, *watermarks[user.key.id_or_name])]
+            if users:
+                ds.put_multi(users)
+
+
+def advance_heart_rate_watermark(user, watermark_nanos, overlap_nanos):
+    """
+    set a user entity's heart rate watermark and overlap unless the stored watermark is already later. Rows
+    inserted into the stored overlap by an earlier watermark, e.g. of a backfill, make the stored overlap unknown
+    :param user: Cloud Datastore entity of backend.DATASTORE_KIND
+    :param watermark_nanos: nanoseconds Unix Epoch time
+    :param overlap_nanos: list of nanoseconds Unix Epoch time, None if unknown
+    :return: whether the entity changed
+    """
+    stored_nanos = user.get(HEART_RATE_WATERMARK) or 0
+    if stored_nanos < watermark_nanos or (stored_nanos == watermark_nanos and overlap_nanos is not None):
+        user[HEART_RATE_WATERMARK] = watermark_nanos
+        if overlap_nanos is None:
+            user.pop(HEART_RATE_OVERLAP, None)
+        else:
+            user[HEART_RATE_OVERLAP] = backend.pack_nanos(overlap_nanos)
+            user.exclude_from_indexes.add(HEART_RATE_OVERLAP)
+        return True
+    if watermark_nanos >= stored_nanos - backend.HEART_RATE_OVERLAP_HOURS * 3600 * 10 ** 9 \
+            and HEART_RATE_OVERLAP in user:
+        del user[HEART_RATE_OVERLAP]
+        return True
+    return False
+
+
+def evict_user_credentials(username):
+    """
+    forget the user's cached credentials, e.g. after their refresh token was rejected
+    :param username: user's Gmail
+    """
+    with _credentials_cache_lock:
+        _credentials_cache.pop(username, None)
 
 
 @app.post('/v1/insert_daily_fitness')
@@ -358,7 +527,12 @@ def insert_daily_fitness_data_ondemand():
                              users_param))
     usernames = request.query[users_param].split(',')
 
-    return insert_daily_fitness_data_impl(usernames)
+    failures = []
+    profiles = load_user_profiles(usernames, failures)
+    failed = set(username for username, _ in failures)
+    return insert_daily_fitness_data_impl([username for username in usernames if username not in failed],
+                                          sink_mode=request.query.get('sink', backend.CRON_SINK),
+                                          profiles=profiles, failures=failures)
 
 
 @app.get('/v1/insert_daily_fitness')
@@ -373,36 +547,141 @@ def insert_daily_fitness_data():
         return HTTPError(httplib.UNAUTHORIZED,
                          'Endpoint can only be invoked from Google App Engine cron jobs per https://cloud.google.com/appengine/docs/flexible/python/scheduling-jobs-with-cron-yaml')
 
-    ds = datastore.Client()
-    query = ds.query(kind=backend.DATASTORE_KIND)
-    query.keys_only()
-    usernames = list(query.fetch())
-    usernames = [u.key.id_or_name for u in usernames]
-
-    return insert_daily_fitness_data_impl(usernames)
+    failures = []
+    profiles = load_user_profiles(failures=failures)
+    return insert_daily_fitness_data_impl(list(profiles), profiles=profiles, failures=failures)
 
 
-def insert_daily_fitness_data_impl(usernames, bucket_name=backend.DEFAULT_BUCKET):
+def insert_daily_fitness_data_impl(usernames, bucket_name=backend.DEFAULT_BUCKET, sink_mode=backend.CRON_SINK,
+                                   profiles=None, failures=None):
     """
     Call Google Fitness API for users in the Cloud Datastore credentials kind, save the responses in Cloud Storage,
     insert the fitness data to Cloud BigQuery.
-    key is retry[username][category]['countdown']
-    if value >= 0, retry down to value -1 or set value to -2 for non-recoverable errors
-    if value is None, op has succeeded
+    retry[username][category] holds the 'error' of a category that failed every attempt, see RetryPolicy,
+    and the 'gs://' paths of its archived results otherwise
     :param usernames: a list of usernames to call Google Fitness API with
     :param bucket_name: save responses from Google Fitness API to a Google Cloud Storage bucket
+    :param sink_mode: 'streaming' inserts each user's heart rate rows right away and MERGEs the other rows of a batch
+    of users with one query per table, 'load' loads all users' rows with one load job per table after every user
+    is fetched
+    :param profiles: optional dict of username to profile from load_user_profiles, read together up front;
+    a user without one is read from Cloud Datastore by its worker
+    :param failures: optional list of (username, exception) of users that failed before the run, e.g. in
+    load_user_profiles, reported with the run's results
     :return: The results of getting from Google Fitness API and inserting to Cloud BigQuery
     """
     retry = {}
-    threads = []
-
-    for username in usernames:
-        t = Thread(target=insert_daily_fitness_data_thread, args=(bucket_name, retry, username))
-        threads.append(t)
-        t.start()
-
-    for t in threads:
-        t.join()
+    run_id = datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+    sink = None
+    if sink_mode == 'load':
+        sink = backend.LoadJobSink(run_id)
+    archive = ArchiveWriter(bucket_name, run_id)
+    # each user is processed once, in the order given, by at most FIT_POOL_SIZE threads
+    usernames = list(OrderedDict.fromkeys(usernames))
+    profiles = profiles or {}
+    budget = max(10, int(backend.RETRY_BUDGET_RATIO * len(usernames)))
+    policy = RetryPolicy(backend.RETRY_MAX_ATTEMPTS, backend.RETRY_BASE_DELAY, backend.RETRY_MAX_DELAY,
+                         breaker=_quota_breaker,
+                         budgets=dict((category, RetryBudget(budget)) for category in set(SINK_CATEGORIES.values())),
+                         quota_pause=backend.QUOTA_PAUSE)
+
+    def prepare(batch, prepared):
+        # flows of a batch of users, their bundles fetched by batch requests, and the users without a flow
+        flows = {}
+        merge_sink = backend.MergeSink() if sink is None else None
+
+        def add_flow(username):
+            flow = new_daily_flow(username, sink, profiles.get(username), merge_sink)
+            # refreshed one user at a time, as prefetch_bundles batches only the users holding a valid token
+            try:
+                backend.refresh_access_token(flow.http_auth)
+            except client.HttpAccessTokenRefreshError:
+                evict_user_credentials(username)
+                raise
+            except Exception as e:
+                # fetches its data on its own, retried by the policy
+                print('unable to refresh the access token of user {}: {}'.format(username, e))
+            flows[username] = flow
+
+        prepared['failures'] = run_in_pool(add_flow, batch, backend.FIT_POOL_SIZE, semaphore=_fit_concurrency)
+        with _fit_concurrency:
+            prefetch_failures = backend.prefetch_bundles([flows[username] for username in batch if username in flows])
+        for username, err in prefetch_failures:
+            print('no prefetched bundle for user {}, getting it on its own: {}'.format(username, err))
+        prepared['flows'] = flows
+        prepared['merge_sink'] = merge_sink
+
+    # heart rate watermarks stored together: a batch's once the batch is done, the sink's once it is flushed
+    sink_watermarks = {}
+
+    def process(flows, watermarks, username):
+        insert_daily_fitness_data_thread(archive, retry, username, sink, flows[username], policy,
+                                         watermarks if sink is None else sink_watermarks)
+
+    def save_watermarks(watermarks):
+        try:
+            policy.call('heartrate', partial(set_heart_rate_watermarks, watermarks))
+        except Exception as e:
+            for username in watermarks:
+                retry[username]['heartrate']['error'] = 'storing the heart rate watermark failed: {}'.format(e)
+
+    # many users' Google Fitness API requests share each batch HTTP request. The next batch is prefetched while the
+    # users of a batch are processed, after which their flows are dropped, so at most two batches are in memory
+    batches = [usernames[i:i + backend.FIT_BATCH_SIZE] for i in range(0, len(usernames), backend.FIT_BATCH_SIZE)]
+    failures = list(failures or [])
+    prepared = {}
+    if batches:
+        prepare(batches[0], prepared)
+    for i, batch in enumerate(batches):
+        if 'flows' in prepared:
+            flows = prepared['flows']
+            merge_sink = prepared['merge_sink']
+            failures += prepared['failures']
+        else:
+            flows = {}
+            merge_sink = None
+            failures += [(username, RuntimeError('preparing the batch failed')) for username in batch]
+        prepared = {}
+        lookahead = None
+        if i + 1 < len(batches):
+            lookahead = Thread(target=prepare, args=(batches[i + 1], prepared))
+            lookahead.start()
+        watermarks = {}
+        failures += run_in_pool(partial(process, flows, watermarks),
+                                [username for username in batch if username in flows],
+                                backend.FIT_POOL_SIZE, semaphore=_fit_concurrency)
+        del flows
+        save_watermarks(watermarks)
+        if merge_sink is not None:
+            # one MERGE per table for the batch's steps, calories and activities
+            report_sink_errors(retry, merge_sink, merge_sink.flush())
+        if lookahead is not None:
+            # a run killed later keeps the results archived so far; the last batch's go with the final upload
+            try:
+                archive.checkpoint(backend.FIT_POOL_SIZE)
+            except Exception as e:
+                print('archive checkpoint of run {} failed: {}'.format(run_id, e))
+            lookahead.join()
+    for username, err in failures:
+        # failed before or between the categories, e.g. the user is missing in Cloud Datastore
+        retry.setdefault(username, {})['user'] = {'error': str(err)}
+    if sink is not None:
+        report_sink_errors(retry, sink, sink.flush())
+        save_watermarks(sink_watermarks)
+    # the shards written since the last checkpoint in parallel, then the manifest mapping users to their results
+    headers = {}
+    try:
+        upload_errors = archive.upload(backend.FIT_POOL_SIZE)
+        for username, category, err in archive.failed_categories(upload_errors):
+            retry[username][category]['error'] = 'archive upload failed: {}'.format(err)
+        for username, categories in retry.items():
+            for category, cat_result in categories.items():
+                if category != 'user' and 'error' not in cat_result:
+                    cat_result['gs://'] = archive.gs_paths(username, category)
+        if archive.manifest_path not in upload_errors:
+            headers['X-Archive-Manifest'] = '{}/{}'.format(bucket_name, archive.manifest_path)
+    finally:
+        archive.close()
 
     is_error = False
     response.content_type = 'application/json'
@@ -412,42 +691,91 @@ def insert_daily_fitness_data_impl(usernames, bucket_name=backend.DEFAULT_BUCKET
                 is_error = True
                 break
     if is_error:
-        return HTTPResponse(retry, httplib.INTERNAL_SERVER_ERROR)
+        return HTTPResponse(retry, httplib.INTERNAL_SERVER_ERROR, headers)
     else:
-        return retry
+        return HTTPResponse(retry, httplib.OK, headers)
 
 
-def insert_daily_fitness_data_thread(bucket_name, retry, username):
-    error_reporting_client = error_reporting.Client()
-    http_context = error_reporting.HTTPContext(method='GET', url='/v1/insert_daily_fitness',
-                                               user_agent='cron job for user {}'.format(username))
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    http_auth, timezone = get_google_http_auth_n_user_timezone(username)
+def report_sink_errors(retry, sink, errors):
+    """
+    report a table's failed load or MERGE to every user with rows in it
+    :param retry: dict of the run's results, see insert_daily_fitness_data_impl
+    :param sink: backend.LoadJobSink or backend.MergeSink that was flushed
+    :param errors: dict of table name to error message from its flush
+    """
+    for table_name, err in errors.items():
+        for username in sink.usernames(table_name):
+            retry[username][SINK_CATEGORIES[table_name]]['error'] = err
+
+
+def new_daily_flow(username, sink=None, profile=None, merge_sink=None):
+    """
+    UserDataFlow of the user's data from the start of the local yesterday until now
+    :param username: username in the Cloud Datastore credentials kind
+    :param sink: optional backend.LoadJobSink to write the rows to
+    :param profile: optional profile of the user from load_user_profiles, saving the Cloud Datastore reads
+    :param merge_sink: optional backend.MergeSink to write the rows but heart rate to, without a sink
+    :return: backend.UserDataFlow
+    """
+    if profile is None:
+        http_auth, timezone = get_google_http_auth_n_user_timezone(username)
+        heart_rate_watermark, heart_rate_overlap = get_heart_rate_watermark(username)
+    else:
+        http_auth = profile['credentials'].authorize(httplib2.Http())
+        timezone = profile['timezone']
+        heart_rate_watermark = profile['heart_rate_watermark']
+        heart_rate_overlap = backend.unpack_nanos(profile['heart_rate_overlap'])
     # get today's local date - 1 day
     yesterday_local = datetime.now(pytz.timezone(timezone)) - timedelta(days=1)
-    yesterday_local_str = yesterday_local.strftime(backend.DATE_FORMAT)
-    df = backend.UserDataFlow(username, http_auth, yesterday_local.year,
-                              yesterday_local.month,
-                              yesterday_local.day, backend.current_milli_time(), timezone)
+    return backend.UserDataFlow(username, http_auth, yesterday_local.year,
+                                yesterday_local.month,
+                                yesterday_local.day, backend.current_milli_time(), timezone,
+                                heart_rate_watermark=heart_rate_watermark, heart_rate_overlap=heart_rate_overlap,
+                                sink=sink, merge_sink=merge_sink)
+
+
+def insert_daily_fitness_data_thread(archive, retry, username, sink=None, df=None, policy=None, watermarks=None):
+    """
+    get and insert a user's data of every category, adding the results to the run's archive
+    :param archive: ArchiveWriter of the run
+    :param retry: dict of the run's results, see insert_daily_fitness_data_impl
+    :param username: username in the Cloud Datastore credentials kind
+    :param sink: optional backend.LoadJobSink to write the rows to
+    :param df: optional UserDataFlow of the user; created when None
+    :param policy: optional RetryPolicy of the run; a default one when None
+    :param watermarks: optional dict to add the user's heart rate watermark and overlap to, for the caller to store
+    with set_heart_rate_watermarks; stored right away when None
+    """
+    from google.cloud import error_reporting
+    error_reporting_client = clients.get_client('error_reporting')
+    http_context = error_reporting.HTTPContext(method='GET', url='/v1/insert_daily_fitness',
+                                               user_agent='cron job for user {}'.format(username))
+    if df is None:
+        df = new_daily_flow(username, sink)
+    if policy is None:
+        policy = RetryPolicy(breaker=_quota_breaker)
+    yesterday_local_str = datetime(df.start_year, df.start_month, df.start_day).strftime(backend.DATE_FORMAT)
+    # as read from Cloud Datastore; stored again only if moved
+    heart_rate_start = (df.heart_rate_watermark, df.heart_rate_overlap)
     retry[username] = {}
     categories = {'heartrate', 'activities', 'steps', 'calories'}
     for category in categories:
         retry[username][category] = {}
-        # countdown is the number of retries
-        retry[username][category]['countdown'] = 1
-        gs_path_get = '{}/{}/{}.json'.format(username, yesterday_local_str, category)
-        gs_path_insert = '{}/{}/{}_inserted_count.json'.format(username, yesterday_local_str, category)
         get_result = None
         insert_result = None
+        succeeded = False
 
         # start of the retry logic
-        while retry[username][category]['countdown'] >= 0:
+        attempt = 0
+        while True:
+            policy.before_attempt()
             try:
                 if category == 'heartrate':
-                    # get and insert heart rate data
-                    insert_result = df.get_and_post_heart_rate()
-                    get_result = insert_result['heart_datasets']
+                    # get and insert heart rate data, spooling the datasets to disk page by page
+                    if get_result is not None:
+                        get_result.close()
+                    get_result = NdjsonArchive()
+                    insert_result = df.get_and_post_heart_rate(archive=get_result)
                 elif category == 'activities':
                     # get and insert activities data
                     get_result = df.get_activities()
@@ -460,50 +788,123 @@ def insert_daily_fitness_data_thread(bucket_name, retry, username):
                     # get and insert calories
                     get_result = df.get_calories()
                     insert_result = df.post_calories()
-                # set to None upon success of getting API data and inserting to BigQuery
-                retry[username][category]['countdown'] = None
+                succeeded = True
+                retry[username][category].pop('error', None)
+                break
             except client.HttpAccessTokenRefreshError as err:
+                evict_user_credentials(username)
                 http_context.responseStatusCode = httplib.UNAUTHORIZED
                 user_token_err = '{} has invalid refresh token'.format(username)
                 error_reporting_client.report_exception(http_context=http_context,
                                                         user=user_token_err)
                 retry[username][category]['error'] = "{}: {}".format(user_token_err, err)
                 # can't recover; abandon retry
-                retry[username][category]['countdown'] = -2
+                break
             except googleapiclient.errors.HttpError as err:
                 http_context.responseStatusCode = err.resp.status
                 error_reporting_client.report_exception(http_context=http_context,
                                                         user='Google API HttpError for user {}'.format(username))
                 retry[username][category]['error'] = str(err)
-                if err.resp.status in (
-                        httplib.BAD_REQUEST, httplib.UNAUTHORIZED, httplib.NOT_FOUND, httplib.FORBIDDEN):
-                    # can't recover; abandon retry
-                    retry[username][category]['countdown'] = -2
+                delay = policy.next_delay(category, attempt, err)
             except Exception as err:
                 # https://googleapis.github.io/google-cloud-python/latest/error-reporting/usage.html
                 error_reporting_client.report_exception(http_context=http_context,
                                                         user='get and insert {} data for {} failed'.format(category,
                                                                                                            username))
                 retry[username][category]['error'] = str(err)
+                delay = policy.next_delay(category, attempt, err)
 
-            # if retry for user on category isn't None, recoverable failure happened, decrement the retry count
-            if retry[username][category]['countdown'] is not None:
-                retry[username][category]['countdown'] -= 1
+            # None when the error can't be recovered from, or the attempts or the category's budget are spent
+            if delay is None:
+                break
+            time.sleep(delay)
+            attempt += 1
+
+        # chunks inserted before a failure moved the watermark as well
+        if category == 'heartrate' and (df.heart_rate_watermark, df.heart_rate_overlap) != heart_rate_start:
+            if watermarks is None:
+                save = partial(set_heart_rate_watermark, username, df.heart_rate_watermark, df.heart_rate_overlap)
+            else:
+                save = partial(watermarks.__setitem__, username, (df.heart_rate_watermark, df.heart_rate_overlap))
+            if sink is None:
+                save()
+            else:
+                # the rows are in BigQuery only once the sink is flushed
+                sink.on_loaded(backend.GCP_table_heartrate, save)
+
+        # per category, archiving the get, insert results upon success; uploaded at the end of the run
+        if succeeded:
+            if isinstance(get_result, NdjsonArchive):
+                archive.add_file(username, yesterday_local_str, category, 'get', get_result.file)
             else:
-                # exiting while loop because None >= 0 is False
-                pass
+                archive.add(username, yesterday_local_str, category, 'get', get_result)
+            archive.add(username, yesterday_local_str, category, 'inserted', insert_result)
 
-        # per category, putting the get, insert results on Cloud Storage upon success
-        if retry[username][category]['countdown'] is None:
-            retry[username][category]['gs://'] = []
-            blob_get_result = bucket.blob(gs_path_get)
-            blob_get_result.upload_from_string(json.dumps(get_result))
-            retry[username][category]['gs://'].append("{}/{}".format(bucket_name, gs_path_get))
-            blob_insert_result = bucket.blob(gs_path_insert)
-            blob_insert_result.upload_from_string(json.dumps(insert_result))
-            retry[username][category]['gs://'].append("{}/{}".format(bucket_name, gs_path_insert))
+        if isinstance(get_result, NdjsonArchive):
+            get_result.close()
 
-        retry[username][category].pop('countdown')
+
+@app.post('/v1/backfill')
+def start_backfill():
+    """
+    backfill users' data of the local dates [start, end) on a background job, in windows checkpointed in
+    Cloud Datastore. Posting the same users, dates and kinds again resumes the job where it stopped.
+    The query string needs ?users=hil@gmail.com,estes@gmail.com and may have ?kinds=steps,heartrate;
+    the headers need start_year, start_month, start_day and may have end_year, end_month, end_day, by default today
+    :return: 202 with the job id, whether this request started it or it is already running, and its status URL
+    """
+    error = check_headers_apikey()
+    if error:
+        return error
+    if 'users' not in request.query:
+        return HTTPError(httplib.BAD_REQUEST, 'users does not exist in query string parameters; '
+                                              'specify ?users=user1@gmail.com,user2@company.com')
+    usernames = request.query['users'].split(',')
+    kinds = request.query.get('kinds', ','.join(backfill.BACKFILL_KINDS)).split(',')
+    unknown_kinds = set(kinds) - set(backfill.BACKFILL_KINDS)
+    if unknown_kinds:
+        return HTTPError(httplib.BAD_REQUEST, 'unknown kinds {}; specify any of {}'.format(
+            ','.join(sorted(unknown_kinds)), ','.join(backfill.BACKFILL_KINDS)))
+    _, start_date, error = extract_header_dates()
+    if error:
+        return error
+    try:
+        start = datetime(start_date['year'], start_date['month'], start_date['day']).date()
+        if 'end_year' in request.headers:
+            end = datetime(int(request.headers['end_year']), int(request.headers['end_month']),
+                           int(request.headers['end_day'])).date()
+        else:
+            end = datetime.now(pytz.timezone(backend.DEFAULT_TIMEZONE)).date()
+    except (KeyError, ValueError) as e:
+        return HTTPError(httplib.BAD_REQUEST, 'invalid start or end date in request.headers: ' + str(e))
+    if start >= end:
+        return HTTPError(httplib.BAD_REQUEST, 'start date must be before end date')
+    profiles = load_user_profiles(usernames)
+    unknown_users = [username for username in usernames if username not in profiles]
+    if unknown_users:
+        return HTTPError(httplib.BAD_REQUEST, 'unknown or invalid users in Cloud Datastore: {}'.format(
+            ','.join(unknown_users)))
+
+    policy = RetryPolicy(backend.RETRY_MAX_ATTEMPTS, backend.RETRY_BASE_DELAY, backend.RETRY_MAX_DELAY,
+                         breaker=_quota_breaker, quota_pause=backend.QUOTA_PAUSE)
+    job_id, started = backfill.start_job(usernames, start, end, kinds, get_google_http_auth_n_user_timezone, policy,
+                                         on_heart_rate=set_heart_rate_watermark, semaphore=_fit_concurrency)
+    return HTTPResponse({'job': job_id, 'status': 'started' if started else 'already running',
+                         'status_url': '/v1/backfill/{}'.format(job_id)}, httplib.ACCEPTED)
+
+
+@app.get('/v1/backfill/<job_id>')
+def get_backfill(job_id):
+    """
+    :return: status of a backfill job: its windows, the completed ones and the errors of its last run
+    """
+    error = check_headers_apikey()
+    if error:
+        return error
+    status = backfill.get_job_status(job_id)
+    if status is None:
+        return HTTPError(httplib.NOT_FOUND, 'no backfill job {}'.format(job_id))
+    return status
 
 
 port = int(os.environ.get('PORT', 8080))
@@ -512,6 +913,7 @@ if prefix:
     app.mount(prefix=prefix, app=app)
 
 if __name__ == "__main__":
+    clients.enable_debugger()
     try:
         try:
             app.run(host='0.0.0.0', port=port, debug=True, server='gunicorn', workers=2, timeout=1200)
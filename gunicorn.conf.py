@@ -0,0 +1,21 @@
+# gunicorn settings of app.yaml's entrypoint: gunicorn -c gunicorn.conf.py fit:app
+import os
+
+import clients
+
+bind = ':{}'.format(os.environ.get('PORT', 8080))
+# --threads 48 fails with ERROR: (gcloud.app.deploy) Error Response: [13] An internal error occurred during deployment. You may need to delete this version manually.
+workers = 8
+threads = 24
+timeout = 3600
+# import the app once in the master; the workers are forked with the modules already loaded
+preload_app = True
+
+
+def when_ready(server):
+    # in the master, after loading the app and before forking the workers
+    clients.warm()
+
+
+def post_fork(server, worker):
+    clients.enable_debugger()
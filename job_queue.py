@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+import json
+import sys
+import traceback
+import uuid
+from threading import Lock, Thread
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+import MySQLdb.cursors
+
+
+class JobQueue(object):
+    """
+    run functions on background threads of the process, recording each job's status in the jobs table so that any
+    process can report it. Jobs are kept in memory: a job still queued or running when its process exits stays so
+    """
+
+    def __init__(self, pool, workers=2):
+        """
+        :param pool: mysql_pool.ConnectionPool of the jobs, apart from the requests' pool so that running jobs
+        can't starve the requests of connections; workers connections are enough
+        :param workers: threads running jobs, started on the first submit so that they run in the forked process
+        """
+        self.pool = pool
+        self.workers = workers
+        self._queue = Queue()
+        self._threads = []
+        self._lock = Lock()
+
+    def submit(self, cur, kind, username, func):
+        """
+        queue a job
+        :param cur: MySQL cursor of the request, whose connection is committed with the job's row so that the job
+        sees the request's writes
+        :param kind: kind of the job, e.g. backfill
+        :param username: user the job is for
+        :param func: function of a MySQL DictCursor, committed after it returns, returning a JSON serializable result
+        :return: job id
+        """
+        job_id = uuid.uuid4().hex
+        cur.execute("INSERT INTO jobs (id, kind, username, status) VALUES (%s, %s, %s, 'queued')",
+                    (job_id, kind, username))
+        cur.connection.commit()
+        with self._lock:
+            if not self._threads:
+                self._threads = [Thread(target=self._work, name='job-{}'.format(n)) for n in range(self.workers)]
+                for t in self._threads:
+                    t.daemon = True
+                    t.start()
+        self._queue.put((job_id, func))
+        return job_id
+
+    def _work(self):
+        while True:
+            job_id, func = self._queue.get()
+            self._set_status(job_id, 'running')
+            try:
+                result = self._run(func)
+            except Exception as e:
+                traceback.print_exc(file=sys.stderr)
+                self._set_status(job_id, 'failed', error=str(e))
+            else:
+                self._set_status(job_id, 'done', result=json.dumps(result))
+
+    def _set_status(self, job_id, status, result=None, error=None):
+        try:
+            self._run(lambda cur: cur.execute("UPDATE jobs SET status=%s, result=%s, error=%s WHERE id=%s",
+                                              (status, result, error, job_id)))
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+
+    def _run(self, func):
+        """
+        call func with a cursor of a pooled connection and commit, or roll back if it raises
+        """
+        conn, created = self.pool.acquire()
+        discard = False
+        cur = conn.cursor(MySQLdb.cursors.DictCursor)
+        try:
+            result = func(cur)
+            conn.commit()
+            return result
+        except MySQLdb.OperationalError:
+            discard = True
+            raise
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            self.pool.release(conn, created, discard)
+
+
+def get_job(cur, job_id):
+    """
+    :param cur: MySQL DictCursor
+    :param job_id: id from JobQueue.submit
+    :return: the job's id, kind, username, status, result, error, created_at and updated_at; None if there is no job
+    """
+    cur.execute("SELECT id, kind, username, status, result, error, created_at, updated_at FROM jobs WHERE id=%s",
+                (job_id,))
+    job = cur.fetchone()
+    if job is None:
+        return None
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    job['created_at'] = str(job['created_at'])
+    job['updated_at'] = str(job['updated_at'])
+    return job
@@ -1,28 +1,41 @@
 #!/usr/bin/env python
-import json
+import time
 from collections import OrderedDict
+from datetime import datetime
+from functools import partial
+from itertools import groupby
+from threading import Lock
 
-import bottle_mysql
+import MySQLdb.cursors
 import httplib2
 from bottle import *
-from googleapiclient.discovery import build
-from oauth2client import client
 
 import backend
+import clients
+import mysql_pool
+import responses
+from job_queue import JobQueue, get_job
 from update_google_fit import get_and_store_fit_data
 
-bad_activities = "(0,3,5,109,110,111,112,117,118)"
-
 # bottle web framework init
 app = Bottle()
 application = app
-# dbhost is optional, default is localhost
-plugin = bottle_mysql.Plugin(dbhost=backend.config.get('database_config', 'dbhost'),
-                             dbport=int(backend.config.get('database_config', 'dbport')),
-                             dbuser=backend.config.get('database_config', 'dbuser'),
-                             dbpass=backend.config.get('database_config', 'dbpass'),
-                             dbname=backend.config.get('database_config', 'dbname'))
+responses.install(app)
+# connections are reused by the requests of the process, at most pool_size at once
+POOL_RECYCLE = backend.config.getint('database_config', 'pool_recycle', fallback=3600)
+pool = mysql_pool.ConnectionPool(lambda: mysql_pool.connect(charset='utf8'),
+                                 size=backend.config.getint('database_config', 'pool_size', fallback=5),
+                                 recycle=POOL_RECYCLE)
+plugin = mysql_pool.PooledMySQLPlugin(pool)
 app.install(plugin)
+# background jobs hold a connection of their own pool for their whole run
+job_queue = JobQueue(mysql_pool.ConnectionPool(lambda: mysql_pool.connect(charset='utf8'), size=backend.JOB_WORKERS,
+                                               recycle=POOL_RECYCLE),
+                     backend.JOB_WORKERS)
+
+# leaderboard name to (expiry time, leaderboard), shared by the requests of the process
+_leaderboard_cache = {}
+_leaderboard_cache_lock = Lock()
 
 
 def require_key():
@@ -33,10 +46,13 @@ def require_key():
 
 @app.get('/health')
 def health_check(db):
-    if db:
-        return "database connection alive: " + str(db.connection)
-    else:
-        return HTTPError(httplib.INTERNAL_SERVER_ERROR, "database connection is in a bad state")
+    stats = pool.stats()
+    try:
+        db.execute("SELECT 1")
+    except Exception as e:
+        stats['error'] = str(e)
+        return HTTPResponse(stats, httplib.INTERNAL_SERVER_ERROR)
+    return stats
 
 
 @app.get('/')
@@ -45,13 +61,7 @@ def default_get(db):
     p = request.urlparts
     redirect_uri = "{}://{}{}".format(p.scheme, p.netloc, p.path)
 
-    flow = client.flow_from_clientsecrets(
-        backend.client_secret_file,
-        scope=["profile", "email", 'https://www.googleapis.com/auth/fitness.activity.read',
-               'https://www.googleapis.com/auth/fitness.body.read'],
-        redirect_uri=redirect_uri)
-    flow.params['access_type'] = 'offline'
-    flow.params['prompt'] = 'consent'
+    flow = backend.make_oauth_flow(redirect_uri)
     if 'code' not in request.query:
         require_key()
         if not name:
@@ -61,69 +71,230 @@ def default_get(db):
     else:
         creds = flow.step2_exchange(code=request.query.code)
         http_auth = creds.authorize(httplib2.Http())
-        user_info_service = build('oauth2', 'v2', http=http_auth)
-        u = user_info_service.userinfo().get().execute()
+        user_info_service = clients.get_service('oauth2', 'v2')
+        u = user_info_service.userinfo().get().execute(http=http_auth)
         db.execute(
             "REPLACE INTO google_fit SET username=%s, google_id=%s, full_name=%s, gender=%s, image_url=%s, email=%s, refresh_token=%s",
             (name, u['id'], u['name'], u.get('gender'), u['picture'], u['email'], creds.refresh_token))
         print("Inserted", u)
-        steps, activity = get_and_store_fit_data(http_auth, db, name)
-        response.content_type = 'application/json'
-        return json.dumps(dict(steps), sort_keys=True, indent=4)
+        # the backfill runs on a connection of the job queue, which sees the user's new row once submit commits
+        job_id = job_queue.submit(db, 'backfill', name, partial(backfill_user, creds, name))
+        return HTTPResponse({'job': job_id, 'status': 'queued', 'status_url': '/jobs/{}'.format(job_id)},
+                            httplib.ACCEPTED)
+
+
+def backfill_user(creds, name, cur):
+    """
+    job storing the fitness data of a user who has just given consent
+    :param creds: the user's OAuth credentials
+    :param name: username
+    :param cur: MySQL DictCursor of the job
+    :return: numbers of days of steps and activity rows got
+    """
+    steps, activity = get_and_store_fit_data(creds.authorize(httplib2.Http()), cur, name)
+    return {'steps_days': len(steps), 'activity_rows': len(activity)}
+
+
+@app.get('/jobs/<job_id>')
+def get_job_status(job_id, db):
+    # job ids are random and only given to the user who started the job, so no API key is required
+    job = get_job(db, job_id)
+    if job is None:
+        return HTTPError(httplib.NOT_FOUND, "no job {}".format(job_id))
+    return job
+
+
+def not_modified(db, table, name):
+    """
+    validate the client's cached response of a user's rows in a table: the ETag is the number of the user's rows and
+    their latest lastUpdated, read from the (username, lastUpdated) index without fetching any row. Sets the ETag
+    header of the response
+    :param db: MySQL cursor
+    :param table: steps or activity
+    :param name: username
+    :return: 304 response when If-None-Match has the current ETag, else None
+    """
+    db.execute("SELECT COUNT(*) AS n, MAX(lastUpdated) AS lastUpdated FROM {} WHERE username=%s".format(table), (name,))
+    r = db.fetchone()
+    last_updated = r['lastUpdated'].strftime('%Y%m%d%H%M%S') if r['lastUpdated'] else '0'
+    # weak, as the gzip, deflate and identity encodings of the body share it
+    etag = 'W/"{}-{}-{}"'.format(table, r['n'], last_updated)
+    if_none_match = request.headers.get('If-None-Match', '')
+    # If-None-Match compares weakly, ignoring W/ on either side
+    tags = [tag.strip()[2:] if tag.strip().startswith('W/') else tag.strip() for tag in if_none_match.split(',')]
+    if etag[2:] in tags or if_none_match.strip() == '*':
+        return HTTPResponse(status=httplib.NOT_MODIFIED, ETag=etag)
+    response.set_header('ETag', etag)
+    return None
+
+
+def day_range():
+    """
+    parse the from, to (inclusive dates as YYYY-MM-DD), after (next page cursor) and limit (days per page) query
+    parameters, aborting with 400 for bad values
+    :return: SQL condition on the day column starting with AND, its parameters, and the limit or None
+    """
+    condition = ''
+    params = []
+    for key, operator in (('from', '>='), ('to', '<='), ('after', '>')):
+        value = request.query.get(key)
+        if value:
+            try:
+                datetime.strptime(value, backend.DATE_FORMAT)
+            except ValueError:
+                abort(httplib.BAD_REQUEST, "{} must be a date as YYYY-MM-DD".format(key))
+            condition += ' AND day {} %s'.format(operator)
+            params.append(value)
+    limit = request.query.get('limit')
+    if limit:
+        if not limit.isdigit() or int(limit) < 1:
+            abort(httplib.BAD_REQUEST, "limit must be a positive number of days")
+        limit = int(limit)
+    else:
+        limit = None
+    return condition, params, limit
+
+
+def page_days(db, table, name, condition, params, limit):
+    """
+    narrow a day condition to the first limit days of a user's rows, setting the X-Next-Cursor header to the
+    after parameter of the next page when there are more days
+    :param db: MySQL cursor
+    :param table: steps or activity
+    :param name: username
+    :param condition: condition from day_range
+    :param params: parameters of condition
+    :param limit: days per page, None for every day
+    :return: condition and its parameters of the page
+    """
+    if limit is None:
+        return condition, params
+    db.execute("SELECT DISTINCT day FROM {} WHERE username=%s{} ORDER BY day LIMIT %s".format(table, condition),
+               [name] + params + [limit + 1])
+    days = [r['day'] for r in db.fetchall()]
+    if len(days) <= limit:
+        return condition, params
+    response.set_header('X-Next-Cursor', str(days[limit - 1]))
+    return condition + ' AND day <= %s', params + [days[limit - 1]]
+
+
+def iter_rows(db, sql, params):
+    """
+    rows of a query from a server-side cursor, so that the rows are never all in memory
+    :param db: MySQL cursor of the request
+    :return: generator of dict rows
+    """
+    cur = db.connection.cursor(MySQLdb.cursors.SSDictCursor)
+    try:
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(500)
+            if not rows:
+                return
+            for r in rows:
+                yield r
+    finally:
+        # reads and drops the rows left when the stream stops early
+        cur.close()
+
+
+def stream_json_object(items, chunk_size=100):
+    """
+    serialize a JSON object member by member
+    :param items: iterable of (key, value)
+    :param chunk_size: members per chunk of the response
+    :return: generator of JSON chunks as UTF-8 bytes
+    """
+    pretty = responses.wants_pretty()
+    chunk = [b'{']
+    separator = b'\n'
+    try:
+        for key, value in items:
+            chunk += [separator, responses.dumps(key), b': ', responses.dumps(value, sort_keys=True, pretty=pretty)]
+            separator = b',\n'
+            if len(chunk) >= chunk_size * 4:
+                yield b''.join(chunk)
+                chunk = []
+    finally:
+        # close the rows' server-side cursor before the connection goes back to the pool
+        if hasattr(items, 'close'):
+            items.close()
+    chunk.append(b'\n}\n')
+    yield b''.join(chunk)
 
 
 @app.get('/steps_for_user/<name>')
 def steps_for_user(name, db):
     require_key()
     print(name)
-    db.execute("SELECT day, steps FROM steps WHERE username=%s", (name,))
-    result = dict([(r['day'], r['steps']) for r in db.fetchall()])
-    print(result)
+    cached = not_modified(db, 'steps', name)
+    if cached:
+        return cached
+    condition, params = page_days(db, 'steps', name, *day_range())
+    rows = iter_rows(db, "SELECT day, steps FROM steps WHERE username=%s{} ORDER BY day".format(condition),
+                     [name] + params)
     response.content_type = 'application/json'
-    return json.dumps(result, sort_keys=True, indent=4)
+    return stream_json_object(day_steps(rows))
+
+
+def day_steps(rows):
+    """
+    :param rows: steps rows from iter_rows
+    :return: generator of (day, steps), closing rows when it is closed, e.g. as the client disconnected
+    """
+    try:
+        for r in rows:
+            yield str(r['day']), r['steps']
+    finally:
+        rows.close()
 
 
 @app.get('/activity_for_user/<name>')
 def activity_for_user(name, db):
     require_key()
     print(name)
+    cached = not_modified(db, 'activity', name)
+    if cached:
+        return cached
     db.execute(
         "SELECT a.day, ROUND(SUM(a.length_ms) / 1000 / 60) AS minutes FROM activity a INNER JOIN activity_types t ON a.activity_type=t.id WHERE a.username=%s AND a.activity_type NOT IN {} GROUP BY a.day".format(
-            bad_activities), (name,))
-    result = dict([(r['day'], int(r['minutes'])) for r in db.fetchall()])
+            backend.BAD_ACTIVITIES), (name,))
+    result = dict([(str(r['day']), int(r['minutes'])) for r in db.fetchall()])
     print(result)
-    response.content_type = 'application/json'
-    return json.dumps(result, sort_keys=True, indent=4)
+    return responses.json_body(result, sort_keys=True)
 
 
 @app.get('/users/<name>/activities')
 def user_activities(name, db):
     require_key()
-    activities = query_activities(db, name)
+    cached = not_modified(db, 'activity', name)
+    if cached:
+        return cached
+    condition, params = page_days(db, 'activity', name, *day_range())
     response.content_type = 'application/json'
-    return json.dumps(activities, sort_keys=True, indent=4)
-
-
-def query_activities(db, name):
-    db.execute(
-        "SELECT a.day, ROUND(a.length_ms / 1000 / 60) AS minutes, t.name as activity_type FROM activity a INNER JOIN activity_types t ON a.activity_type=t.id WHERE a.username=%s",
-        (name,))
-    result = db.fetchall()
-    activities = {}
-    for r in result:
-        if r['day'] in activities:
-            if 'daily_activities' not in activities[r['day']]:
-                activities[r['day']]['daily_activities'] = []
-
-            activities[r['day']]['daily_activities'].append(
-                {"minutes": int(r['minutes']), "activity_type": r['activity_type']})
-
-        else:
-            activities[r['day']] = {}
-            activities[r['day']]['daily_activities'] = []
-            activities[r['day']]['daily_activities'].append(
-                {"minutes": int(r['minutes']), "activity_type": r['activity_type']})
-    return activities
+    return stream_json_object(query_activities(db, name, condition, params))
+
+
+def query_activities(db, name, condition='', params=()):
+    """
+    a user's activities of each day, streamed from the database in day order
+    :param db: MySQL cursor
+    :param name: username
+    :param condition: SQL condition on day starting with AND, e.g. from day_range
+    :param params: parameters of condition
+    :return: generator of (day, {'daily_activities': [{'minutes':, 'activity_type':}]})
+    """
+    rows = iter_rows(
+        db,
+        "SELECT a.day, ROUND(a.length_ms / 1000 / 60) AS minutes, t.name as activity_type FROM activity a INNER JOIN activity_types t ON a.activity_type=t.id WHERE a.username=%s{} ORDER BY a.day".format(
+            condition),
+        [name] + list(params))
+    try:
+        for day, day_rows in groupby(rows, key=lambda r: r['day']):
+            yield str(day), {'daily_activities': [{"minutes": int(r['minutes']), "activity_type": r['activity_type']}
+                                                  for r in day_rows]}
+    finally:
+        rows.close()
 
 
 @app.get('/steps_for_user/last_week/<name>')
@@ -146,66 +317,167 @@ def steps_for_user_last_day(name, db):
     return result
 
 
+def requested_users(db):
+    """
+    usernames of a bulk request: the comma separated users query parameter, or the members of the group parameter
+    :param db: MySQL cursor
+    :return: list of usernames
+    """
+    if 'users' in request.query:
+        # the same user spelled twice is requested once, as the first spelling without surrounding spaces
+        users = OrderedDict()
+        for u in request.query.get('users').split(','):
+            if u.strip():
+                users.setdefault(user_key(u), u.strip())
+        return list(users.values())
+    elif 'group' in request.query:
+        db.execute("SELECT username FROM user_groups WHERE group_name=%s ORDER BY username",
+                   (request.query.get('group'),))
+        return [r['username'] for r in db.fetchall()]
+    abort(httplib.BAD_REQUEST, "users or group is required")
+
+
+def user_key(username):
+    """
+    :return: username ignoring case and surrounding spaces, to request a user once. Usernames of the same key are
+    equal in the case-insensitive collation of the tables, which may fold more, e.g. accents, see requested_index
+    """
+    return username.strip().lower()
+
+
+def requested_index(users, column='username'):
+    """
+    SQL expression of the 1-based index of the first requested username equal to a row's username, compared by
+    MySQL with the column's collation, so that a row whose stored spelling differs from the requested one is still
+    reported under the requested one. A user requested with spellings the collation finds equal but user_key
+    doesn't, e.g. with and without an accent, is reported under the first of them
+    :param users: usernames of a bulk request, also to be passed as the expression's parameters
+    :param column: username column of the query
+    :return: FIELD expression with a %s placeholder per user
+    """
+    return 'FIELD({}, {})'.format(column, ', '.join(['%s'] * len(users)))
+
+
+def steps_for_users_since(db, interval):
+    """
+    sum of steps of each requested user since an interval before today, with one query for every user
+    :param db: MySQL cursor
+    :param interval: MySQL interval such as 1 WEEK
+    :return: JSON of username to sum of steps, null for a user without steps
+    """
+    users = requested_users(db)
+    result = OrderedDict((u, None) for u in users)
+    if users:
+        db.execute(
+            "SELECT {} AS requested, SUM(steps) as sum FROM steps WHERE username IN ({}) AND day >= date_sub(CURDATE(), INTERVAL {}) GROUP BY username".format(
+                requested_index(users), ', '.join(['%s'] * len(users)), interval), users + users)
+        for r in db.fetchall():
+            result[users[r['requested'] - 1]] = int(r['sum'])
+    return responses.json_body(result)
+
+
+@app.get('/steps_for_users/last_week')
+def steps_for_users_last_week(db):
+    require_key()
+    return steps_for_users_since(db, '1 WEEK')
+
+
+@app.get('/steps_for_users/last_day')
+def steps_for_users_last_day(db):
+    require_key()
+    return steps_for_users_since(db, '1 DAY')
+
+
+@app.get('/activity_for_users')
+def activity_for_users(db):
+    require_key()
+    users = requested_users(db)
+    result = OrderedDict((u, {}) for u in users)
+    if users:
+        db.execute(
+            "SELECT {} AS requested, a.day, ROUND(SUM(a.length_ms) / 1000 / 60) AS minutes FROM activity a INNER JOIN activity_types t ON a.activity_type=t.id WHERE a.username IN ({}) AND a.activity_type NOT IN {} GROUP BY a.username, a.day".format(
+                requested_index(users, 'a.username'), ', '.join(['%s'] * len(users)),
+                backend.BAD_ACTIVITIES), users + users)
+        for r in db.fetchall():
+            result[users[r['requested'] - 1]][str(r['day'])] = int(r['minutes'])
+    return responses.json_body(result, sort_keys=True)
+
+
 @app.get('/users')
 def get_users(db):
     require_key()
     db.execute("SELECT username FROM google_fit")
     result = [u['username'] for u in db.fetchall()]
     print(result)
-    response.content_type = 'application/json'
-    return json.dumps(result, sort_keys=True, indent=4)
+    return responses.json_body(result, sort_keys=True)
+
+
+def cached_leaderboard(name, compute):
+    """
+    serve a leaderboard from memory for LEADERBOARD_CACHE_TTL seconds after computing it
+    :param name: cache key of the leaderboard
+    :param compute: function returning the leaderboard
+    :return: leaderboard
+    """
+    now = time.time()
+    with _leaderboard_cache_lock:
+        cached = _leaderboard_cache.get(name)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    result = compute()
+    with _leaderboard_cache_lock:
+        _leaderboard_cache[name] = (now + backend.LEADERBOARD_CACHE_TTL, result)
+    return result
 
 
 @app.get('/step_leaderboard')
 def steps_leaderboard(db):
     require_key()
-    db.execute(
-        "SELECT username, SUM(steps) as steps FROM steps WHERE day > date_sub(CURDATE(), INTERVAL 1 WEEK) GROUP BY username ORDER BY steps DESC LIMIT 20")
-    result = OrderedDict([(r['username'], int(r['steps'])) for r in db.fetchall()])
-    print(result)
-    response.content_type = 'application/json'
-    return json.dumps(result, indent=4)
+
+    def compute():
+        db.execute(
+            "SELECT username, SUM(steps) AS steps FROM daily_totals WHERE day > date_sub(CURDATE(), INTERVAL 1 WEEK) GROUP BY username HAVING steps IS NOT NULL ORDER BY steps DESC LIMIT 20")
+        result = OrderedDict([(r['username'], int(r['steps'])) for r in db.fetchall()])
+        print(result)
+        return result
+
+    return responses.json_body(cached_leaderboard('steps', compute))
 
 
 @app.get('/activity_leaderboard')
 def activity_leaderboard(db):
     require_key()
-    db.execute(
-        "SELECT username, ROUND(SUM(a.length_ms) / 1000 / 60) AS minutes FROM activity a INNER JOIN activity_types t ON a.activity_type=t.id WHERE day > date_sub(CURDATE(), INTERVAL 1 WEEK) AND a.activity_type NOT IN {} GROUP BY username ORDER BY minutes DESC LIMIT 20".format(
-            bad_activities))
-    result = OrderedDict([(r['username'], int(r['minutes'])) for r in db.fetchall()])
-    print(result)
-    response.content_type = 'application/json'
-    return json.dumps(result, indent=4)
+
+    def compute():
+        db.execute(
+            "SELECT username, ROUND(SUM(active_ms) / 1000 / 60) AS minutes FROM daily_totals WHERE day > date_sub(CURDATE(), INTERVAL 1 WEEK) GROUP BY username HAVING minutes IS NOT NULL ORDER BY minutes DESC LIMIT 20")
+        result = OrderedDict([(r['username'], int(r['minutes'])) for r in db.fetchall()])
+        print(result)
+        return result
+
+    return responses.json_body(cached_leaderboard('activity', compute))
 
 
 @app.get('/combined_leaderboard')
 def combined_leaderboard(db):
     require_key()
-    db.execute("""SELECT s.username, s.steps, m.minutes
-FROM (
-  SELECT username, SUM( steps ) AS steps
-  FROM steps
-  WHERE DAY > DATE_SUB( CURDATE( ) , INTERVAL 1 WEEK )
-  GROUP BY username
-) AS s
-INNER JOIN (
-  SELECT username, ROUND( SUM( a.length_ms ) /1000 /60 ) AS minutes
-  FROM activity a
-  INNER JOIN activity_types t ON a.activity_type = t.id
-  WHERE a.day > DATE_SUB( CURDATE( ) , INTERVAL 1 WEEK )
-  AND a.activity_type NOT
-  IN {}
-  GROUP BY a.username
-) AS m ON s.username = m.username
-ORDER BY s.steps DESC
-LIMIT 20""".format(bad_activities))
-    result = []
-    for r in db.fetchall():
-        result += [r['username'], int(r['steps']), int(r['minutes'])]
-    print(result)
-    response.content_type = 'application/json'
-    return json.dumps(result, indent=4)
+
+    def compute():
+        db.execute("""SELECT username, SUM( steps ) AS steps, ROUND( SUM( active_ms ) /1000 /60 ) AS minutes
+FROM daily_totals
+WHERE day > DATE_SUB( CURDATE( ) , INTERVAL 1 WEEK )
+GROUP BY username
+HAVING steps IS NOT NULL
+AND minutes IS NOT NULL
+ORDER BY steps DESC
+LIMIT 20""")
+        result = []
+        for r in db.fetchall():
+            result += [r['username'], int(r['steps']), int(r['minutes'])]
+        print(result)
+        return result
+
+    return responses.json_body(cached_leaderboard('combined', compute))
 
 
 @app.get('/set_goal/<name>/<goal>')
@@ -215,6 +487,13 @@ def set_goal(name, goal, db):
     return "Goal set"
 
 
+@app.get('/set_group/<name>/<group>')
+def set_group(name, group, db):
+    require_key()
+    db.execute("REPLACE INTO user_groups SET username=%s, group_name=%s", (name, group))
+    return "Group set"
+
+
 port = int(os.environ.get('PORT', 8080))
 prefix = os.environ.get('PREFIX', None)
 if prefix:
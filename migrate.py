@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+versioned MySQL schema migrations. Each migrations/<version>_<name>.sql is applied once, in version order,
+and recorded in the schema_migrations table.
+
+python migrate.py status
+python migrate.py up
+python migrate.py partition --start 2019-01 --end 2021-12 steps activity daily_totals
+"""
+import argparse
+import os
+import re
+from datetime import date
+
+import mysql_pool
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILENAME = re.compile(r'^(\d+)_(\w+)\.sql$')
+# tables with a DATE day column in their primary key, which partition can split by month
+PARTITIONED_TABLES = ('steps', 'activity', 'daily_totals')
+
+
+def list_migrations():
+    """
+    :return: list of (version, name, path) of the migration files in version order
+    """
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILENAME.match(filename)
+        if match:
+            migrations.append((match.group(1), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    return sorted(migrations, key=lambda m: int(m[0]))
+
+
+def applied_versions(cur):
+    """
+    :param cur: MySQL cursor
+    :return: set of the versions recorded in schema_migrations, created if missing
+    """
+    cur.execute("""CREATE TABLE IF NOT EXISTS `schema_migrations` (
+  `version` varchar(255) NOT NULL,
+  `name` varchar(255) NOT NULL,
+  `applied_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`version`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1""")
+    cur.execute("SELECT version FROM schema_migrations")
+    return set(r[0] for r in cur.fetchall())
+
+
+def split_statements(sql):
+    """
+    split a migration file into statements ending with a semicolon at the end of a line; comment lines are dropped
+    :param sql: content of a migration file
+    :return: list of statements
+    """
+    statements = []
+    lines = []
+    for line in sql.splitlines():
+        if not line.strip() or line.strip().startswith('--'):
+            continue
+        lines.append(line)
+        if line.rstrip().endswith(';'):
+            statements.append('\n'.join(lines).rstrip().rstrip(';'))
+            lines = []
+    if lines:
+        statements.append('\n'.join(lines))
+    return statements
+
+
+def status(db):
+    cur = db.cursor()
+    applied = applied_versions(cur)
+    for version, name, path in list_migrations():
+        print('{} {} {}'.format('applied' if version in applied else 'pending', version, name))
+    cur.close()
+
+
+def up(db):
+    """
+    apply the pending migrations in version order, stopping at the first failure. MySQL commits DDL implicitly,
+    so a migration is recorded right after its last statement succeeds
+    """
+    cur = db.cursor()
+    applied = applied_versions(cur)
+    for version, name, path in list_migrations():
+        if version in applied:
+            continue
+        print('applying {} {}'.format(version, name))
+        with open(path) as f:
+            for statement in split_statements(f.read()):
+                cur.execute(statement)
+        cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+        db.commit()
+    cur.close()
+
+
+def month_starts(start, end):
+    """
+    :param start: first month as YYYY-MM
+    :param end: last month as YYYY-MM
+    :return: list of the dates of the first day of every month from start to the month after end
+    """
+    year, month = [int(v) for v in start.split('-')]
+    end_year, end_month = [int(v) for v in end.split('-')]
+    months = [date(year, month, 1)]
+    while (year, month) <= (end_year, end_month):
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        months.append(date(year, month, 1))
+    return months
+
+
+def partition(db, tables, start, end):
+    """
+    range partition tables by the month of day, one partition per month from start to end and one for the later days.
+    Run it again with a later end to add months; the table is rebuilt each time
+    """
+    months = month_starts(start, end)
+    partitions = ["PARTITION p_before VALUES LESS THAN ('{}')".format(months[0].isoformat())]
+    for month, next_month in zip(months, months[1:]):
+        partitions.append("PARTITION p{} VALUES LESS THAN ('{}')".format(month.strftime('%Y%m'),
+                                                                         next_month.isoformat()))
+    partitions.append("PARTITION p_future VALUES LESS THAN (MAXVALUE)")
+    cur = db.cursor()
+    for table in tables:
+        if table not in PARTITIONED_TABLES:
+            raise ValueError('{} is not one of {}'.format(table, ', '.join(PARTITIONED_TABLES)))
+        print('partitioning {} by month from {} to {}'.format(table, start, end))
+        cur.execute("ALTER TABLE `{}` PARTITION BY RANGE COLUMNS(`day`) (\n  {}\n)".format(
+            table, ',\n  '.join(partitions)))
+    cur.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='MySQL schema migrations')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('status', help='list applied and pending migrations')
+    subparsers.add_parser('up', help='apply pending migrations')
+    partition_parser = subparsers.add_parser('partition', help='range partition tables by month of day')
+    partition_parser.add_argument('--start', required=True, help='first month, YYYY-MM')
+    partition_parser.add_argument('--end', required=True, help='last month, YYYY-MM')
+    partition_parser.add_argument('tables', nargs='*', default=list(PARTITIONED_TABLES),
+                                  help='tables to partition, default: {}'.format(' '.join(PARTITIONED_TABLES)))
+    args = parser.parse_args()
+
+    db = mysql_pool.connect()
+    try:
+        if args.command == 'status':
+            status(db)
+        elif args.command == 'up':
+            up(db)
+        elif args.command == 'partition':
+            partition(db, args.tables, args.start, args.end)
+        else:
+            parser.print_help()
+    finally:
+        db.close()
@@ -0,0 +1,23 @@
+-- daily_totals rollup of steps and activity, as created by structure.sql before the migrations existed,
+-- filled from the rows stored before the rollup; 0001 then turns its day column into a DATE
+
+CREATE TABLE IF NOT EXISTS `daily_totals` (
+  `username` varchar(255) NOT NULL,
+  `day` varchar(255) NOT NULL,
+  `steps` int(11) DEFAULT NULL,
+  `active_ms` bigint(20) DEFAULT NULL,
+  `lastUpdated` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`username`,`day`),
+  KEY `day` (`day`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+REPLACE INTO `daily_totals` (username, day, steps, active_ms)
+SELECT d.username, d.day,
+  (SELECT s.steps FROM `steps` s WHERE s.username = d.username AND s.day = d.day),
+  (SELECT SUM(a.length_ms) FROM `activity` a INNER JOIN `activity_types` t ON a.activity_type = t.id
+   WHERE a.username = d.username AND a.day = d.day AND a.activity_type NOT IN (0,3,5,109,110,111,112,117,118))
+FROM (
+  SELECT username, day FROM `steps`
+  UNION
+  SELECT username, day FROM `activity`
+) AS d;
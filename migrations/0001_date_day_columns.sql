@@ -0,0 +1,14 @@
+-- day columns of steps, activity and daily_totals as DATE, indexed by day for the date range queries of main.py
+
+ALTER TABLE `steps`
+  MODIFY `day` date NOT NULL,
+  ADD KEY `day_username` (`day`,`username`);
+
+ALTER TABLE `activity`
+  MODIFY `day` date NOT NULL,
+  ADD KEY `day_username` (`day`,`username`);
+
+ALTER TABLE `daily_totals`
+  MODIFY `day` date NOT NULL,
+  DROP KEY `day`,
+  ADD KEY `day_username` (`day`,`username`);
@@ -0,0 +1,7 @@
+-- (username, lastUpdated) indexes to validate main.py's per-user ETags without reading the rows
+
+ALTER TABLE `steps`
+  ADD KEY `username_lastUpdated` (`username`,`lastUpdated`);
+
+ALTER TABLE `activity`
+  ADD KEY `username_lastUpdated` (`username`,`lastUpdated`);
@@ -0,0 +1,9 @@
+-- groups of users for the bulk read endpoints of main.py, e.g. /steps_for_users/last_week?group=
+
+CREATE TABLE IF NOT EXISTS `user_groups` (
+  `group_name` varchar(255) NOT NULL,
+  `username` varchar(255) NOT NULL,
+  `lastModified` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`group_name`,`username`),
+  KEY `username` (`username`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
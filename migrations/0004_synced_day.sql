@@ -0,0 +1,5 @@
+-- local day of each user's last complete sync by update_google_fit.get_and_store_fit_data, to shrink the next one
+
+ALTER TABLE `google_fit`
+  ADD COLUMN `synced_day` date DEFAULT NULL AFTER `refresh_token`,
+  ADD KEY `username` (`username`);
@@ -0,0 +1,14 @@
+-- background jobs of job_queue.JobQueue, e.g. the backfill of a new user, reported by /jobs/<id>
+
+CREATE TABLE IF NOT EXISTS `jobs` (
+  `id` varchar(32) NOT NULL,
+  `kind` varchar(255) NOT NULL,
+  `username` varchar(255) NOT NULL,
+  `status` varchar(16) NOT NULL,
+  `result` text,
+  `error` text,
+  `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `updated_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  KEY `username` (`username`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+MySQL connection pool and a bottle plugin passing a pooled cursor to the route callbacks that take a db argument,
+a drop-in for bottle_mysql.Plugin that reuses connections between requests instead of connecting for each one
+"""
+import inspect
+import time
+from threading import Condition
+
+import MySQLdb
+import MySQLdb.cursors
+import bottle
+
+import backend
+
+
+def connect(**kwargs):
+    """
+    connect to the MySQL database of the database_config section of APP_CONFIG
+    :param kwargs: more MySQLdb.connect arguments, e.g. cursorclass
+    :return: MySQLdb connection
+    """
+    return MySQLdb.connect(host=backend.config.get('database_config', 'dbhost'),
+                           port=int(backend.config.get('database_config', 'dbport')),
+                           user=backend.config.get('database_config', 'dbuser'),
+                           passwd=backend.config.get('database_config', 'dbpass'),
+                           db=backend.config.get('database_config', 'dbname'),
+                           **kwargs)
+
+
+class ConnectionPool(object):
+    """
+    thread-safe pool of at most size connections. An idle connection is pinged before it is handed out again
+    if it has been idle for ping_after seconds, and replaced once it is older than recycle seconds, before MySQL's
+    wait_timeout or a Cloud SQL restart drops it
+    """
+
+    def __init__(self, connect, size=5, recycle=3600, ping_after=10, timeout=30):
+        """
+        :param connect: function returning a new connection
+        :param size: maximum number of open connections
+        :param recycle: seconds after which a connection is closed instead of reused
+        :param ping_after: seconds of idleness after which a connection is pinged before reuse
+        :param timeout: seconds to wait for a connection when all of them are in use
+        """
+        self.connect = connect
+        self.size = size
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self.timeout = timeout
+        # idle connections as [(connection, created time, released time)], most recently released last
+        self._idle = []
+        self._open = 0
+        self._condition = Condition()
+        self._counters = {'connects': 0, 'checkouts': 0, 'waits': 0, 'recycled': 0, 'dead': 0, 'discarded': 0}
+
+    def acquire(self):
+        """
+        :return: (connection, created time) to give back with release
+        """
+        deadline = time.time() + self.timeout
+        with self._condition:
+            self._counters['checkouts'] += 1
+            while not self._idle and self._open >= self.size:
+                self._counters['waits'] += 1
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError('no MySQL connection available in {} seconds'.format(self.timeout))
+                self._condition.wait(remaining)
+            if self._idle:
+                conn, created, released = self._idle.pop()
+            else:
+                conn = None
+            # reserve the slot; connecting and pinging happen outside of the lock
+            self._open += 1 if conn is None else 0
+
+        if conn is not None:
+            now = time.time()
+            if now - created > self.recycle:
+                self._close(conn)
+                self._count('recycled')
+                conn = None
+            elif now - released > self.ping_after:
+                try:
+                    conn.ping()
+                except MySQLdb.Error:
+                    self._close(conn)
+                    self._count('dead')
+                    conn = None
+        if conn is None:
+            try:
+                conn = self.connect()
+            except Exception:
+                with self._condition:
+                    self._open -= 1
+                    self._condition.notify()
+                raise
+            created = time.time()
+            self._count('connects')
+        return conn, created
+
+    def release(self, conn, created, discard=False):
+        """
+        give back a connection from acquire
+        :param discard: close the connection instead of reusing it, e.g. after a connection error
+        """
+        if discard:
+            self._close(conn)
+        with self._condition:
+            if discard:
+                self._open -= 1
+                self._counters['discarded'] += 1
+            else:
+                self._idle.append((conn, created, time.time()))
+            self._condition.notify()
+
+    def stats(self):
+        """
+        :return: dict of the pool size, open, idle and in use connections and the counters since the pool started
+        """
+        with self._condition:
+            stats = dict(self._counters)
+            stats.update(size=self.size, open=self._open, idle=len(self._idle),
+                         in_use=self._open - len(self._idle))
+        return stats
+
+    def _count(self, counter):
+        with self._condition:
+            self._counters[counter] += 1
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
+
+class PooledMySQLPlugin(object):
+    """
+    pass a DictCursor of a pooled connection to route callbacks that accept a db keyword argument, committing
+    after the callback like bottle_mysql.Plugin and rolling back when it raises
+    """
+    name = 'mysql'
+    api = 2
+
+    def __init__(self, pool, keyword='db', autocommit=True):
+        self.pool = pool
+        self.keyword = keyword
+        self.autocommit = autocommit
+
+    def setup(self, app):
+        for other in app.plugins:
+            if other is not self and getattr(other, 'keyword', None) == self.keyword:
+                raise bottle.PluginError("Found another plugin with the keyword {}".format(self.keyword))
+
+    def apply(self, callback, route):
+        try:
+            args = inspect.getfullargspec(route.callback).args
+        except AttributeError:
+            args = inspect.getargspec(route.callback).args
+        if self.keyword not in args:
+            return callback
+
+        def wrapper(*args, **kwargs):
+            try:
+                conn, created = self.pool.acquire()
+            except (MySQLdb.Error, RuntimeError) as e:
+                raise bottle.HTTPError(500, "Database Error", e)
+            discard = False
+            cur = conn.cursor(MySQLdb.cursors.DictCursor)
+            kwargs[self.keyword] = cur
+            try:
+                rv = callback(*args, **kwargs)
+                if inspect.isgenerator(rv):
+                    # a streamed response reads from the connection while it is sent; the stream gives it back
+                    stream = self._stream(rv, conn, created, cur)
+                    conn = None
+                    return stream
+                if self.autocommit:
+                    conn.commit()
+                return rv
+            except bottle.HTTPError:
+                conn.rollback()
+                raise
+            except bottle.HTTPResponse:
+                # e.g. a redirect; like bottle_mysql, commit what the callback has done
+                if self.autocommit:
+                    conn.commit()
+                raise
+            except MySQLdb.IntegrityError as e:
+                conn.rollback()
+                raise bottle.HTTPError(500, "Database Error", e)
+            except MySQLdb.OperationalError:
+                # the connection may be broken, e.g. lost or timed out
+                discard = True
+                raise
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                if conn is not None:
+                    self._release(conn, created, cur, discard)
+
+        return wrapper
+
+    def _stream(self, body, conn, created, cur):
+        """
+        yield the chunks of a callback's generator, then commit and give back the connection. bottle closes the
+        stream after sending the response or when the client goes away, which rolls back instead
+        """
+        discard = False
+        done = False
+        try:
+            for chunk in body:
+                yield chunk
+            if self.autocommit:
+                conn.commit()
+            done = True
+        except MySQLdb.OperationalError:
+            discard = True
+            raise
+        finally:
+            body.close()
+            if not done and not discard:
+                try:
+                    conn.rollback()
+                except MySQLdb.Error:
+                    discard = True
+            self._release(conn, created, cur, discard)
+
+    def _release(self, conn, created, cur, discard):
+        try:
+            cur.close()
+        except MySQLdb.Error:
+            discard = True
+        self.pool.release(conn, created, discard)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+import sys
+import traceback
+from threading import Thread
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+
+def run_in_pool(func, items, pool_size, semaphore=None, initializer=None, finalizer=None):
+    """
+    call func(item) for every item on at most pool_size threads; items are started in order,
+    so every item gets a worker before any item queued after it
+    :param func: function of one item
+    :param items: iterable of items
+    :param pool_size: maximum number of worker threads
+    :param semaphore: optional threading semaphore held during each call, to cap concurrent calls across pools
+    :param initializer: optional function called in each worker thread before its first item
+    :param finalizer: optional function called in each worker thread after its last item
+    :return: list of (item, exception) for the calls that raised, and for the items left when the initializer
+    raised in every worker
+    """
+    work = Queue()
+    for item in items:
+        work.put(item)
+    failures = []
+    initializer_errors = []
+
+    def worker():
+        if initializer is not None:
+            try:
+                initializer()
+            except Exception as e:
+                # the other workers take this worker's items
+                traceback.print_exc(file=sys.stderr)
+                initializer_errors.append(e)
+                return
+        try:
+            while True:
+                try:
+                    item = work.get_nowait()
+                except Empty:
+                    return
+                if semaphore is not None:
+                    semaphore.acquire()
+                try:
+                    func(item)
+                except Exception as e:
+                    traceback.print_exc(file=sys.stderr)
+                    failures.append((item, e))
+                finally:
+                    if semaphore is not None:
+                        semaphore.release()
+        finally:
+            if finalizer is not None:
+                finalizer()
+
+    threads = [Thread(target=worker) for _ in range(min(pool_size, work.qsize()))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    while initializer_errors:
+        try:
+            failures.append((work.get_nowait(), initializer_errors[-1]))
+        except Empty:
+            break
+    return failures
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""
+JSON response layer shared by main.py and fit.py: serializes with the fastest JSON library installed, pretty prints
+only for ?pretty, and compresses responses with gzip or deflate as negotiated by Accept-Encoding
+"""
+import inspect
+import json
+import zlib
+
+import bottle
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# responses smaller than this are sent uncompressed, as compressing them saves less than it costs
+MIN_COMPRESS_BYTES = 1024
+COMPRESS_LEVEL = 6
+# zlib wbits of each Content-Encoding
+ENCODING_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def dumps(obj, sort_keys=False, pretty=False):
+    """
+    serialize obj to JSON with orjson, else ujson, else the json module; pretty printing always uses the json module
+    :param obj: JSON serializable object
+    :param sort_keys: sort the keys of dicts; keep it False for OrderedDict
+    :param pretty: indent by 4 spaces
+    :return: JSON as UTF-8 bytes
+    """
+    if pretty:
+        return encode(json.dumps(obj, sort_keys=sort_keys, indent=4))
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+        except TypeError:
+            # e.g. keys that are not strings, which the json module converts
+            pass
+    elif ujson is not None:
+        try:
+            return encode(ujson.dumps(obj, sort_keys=sort_keys))
+        except (TypeError, OverflowError):
+            pass
+    return encode(json.dumps(obj, sort_keys=sort_keys, separators=(',', ':')))
+
+
+def encode(text):
+    """
+    :return: text as UTF-8 bytes
+    """
+    return text if isinstance(text, bytes) else text.encode('utf-8')
+
+
+def wants_pretty():
+    """
+    :return: whether the request asks for indented JSON with ?pretty, ?pretty=1 or ?pretty=true
+    """
+    return 'pretty' in bottle.request.query and bottle.request.query.get('pretty').lower() in ('', '1', 'true')
+
+
+def json_body(obj, sort_keys=False):
+    """
+    serialize obj as the JSON body of the current response, pretty printed if the request asks for it
+    :param obj: JSON serializable object
+    :param sort_keys: sort the keys of dicts; keep it False for OrderedDict
+    :return: response body
+    """
+    bottle.response.content_type = 'application/json'
+    return dumps(obj, sort_keys=sort_keys, pretty=wants_pretty())
+
+
+def negotiate_encoding():
+    """
+    :return: gzip or deflate, whichever the client accepts, gzip first; None for neither
+    """
+    accepted = {}
+    for part in bottle.request.headers.get('Accept-Encoding', '').split(','):
+        fields = part.strip().split(';')
+        q = 1.0
+        for param in fields[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[fields[0].strip().lower()] = q
+    for encoding in ('gzip', 'deflate'):
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def compress_stream(chunks, encoding):
+    """
+    compress an iterable of response chunks, closing it when the stream is closed
+    :param chunks: iterable of bytes or str
+    :param encoding: gzip or deflate
+    :return: generator of compressed bytes
+    """
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, ENCODING_WBITS[encoding])
+    try:
+        for chunk in chunks:
+            data = compressor.compress(encode(chunk))
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+class JSONResponsePlugin(object):
+    """
+    replaces bottle's JSONPlugin: serializes dicts, lists and HTTPResponse bodies of dicts with dumps, and
+    compresses text, JSON and streamed responses for clients that accept gzip or deflate
+    """
+    name = 'json'
+    api = 2
+
+    def apply(self, callback, route):
+        def wrapper(*args, **kwargs):
+            rv = callback(*args, **kwargs)
+            target = rv if isinstance(rv, bottle.HTTPResponse) else bottle.response
+            if isinstance(rv, bottle.HTTPResponse):
+                if isinstance(rv.body, (dict, list)):
+                    rv.body = dumps(rv.body, pretty=wants_pretty())
+                    rv.content_type = 'application/json'
+                if isinstance(rv, bottle.HTTPError):
+                    return rv
+                if rv.status_code == 304:
+                    # a 304 carries the Vary of the response it validates
+                    rv.add_header('Vary', 'Accept-Encoding')
+                    return rv
+                rv.body = self.compress(rv.body, rv)
+                return rv
+            if isinstance(rv, (dict, list)):
+                rv = json_body(rv)
+            return self.compress(rv, target)
+
+        return wrapper
+
+    def compress(self, body, target):
+        """
+        :param body: response body
+        :param target: bottle.response, or the HTTPResponse returned by the route
+        :return: body compressed with the negotiated encoding, or as is
+        """
+        if 'Content-Encoding' in target.headers:
+            return body
+        # caches keep the encodings apart even for a body too small to compress this time
+        target.add_header('Vary', 'Accept-Encoding')
+        streamed = inspect.isgenerator(body)
+        if not streamed and not (isinstance(body, (bytes, type(u''))) and len(body) >= MIN_COMPRESS_BYTES):
+            return body
+        encoding = negotiate_encoding()
+        if encoding is None:
+            return body
+        target.set_header('Content-Encoding', encoding)
+        if streamed:
+            return compress_stream(body, encoding)
+        body = encode(body)
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, ENCODING_WBITS[encoding])
+        return compressor.compress(body) + compressor.flush()
+
+
+def install(app):
+    """
+    use JSONResponsePlugin instead of bottle's JSONPlugin; install it before the other plugins so that it wraps them
+    """
+    app.uninstall('json')
+    app.install(JSONResponsePlugin())
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+import email.utils
+import random
+import socket
+import ssl
+import time
+from threading import Lock
+
+import googleapiclient.errors
+import httplib2
+from google.api_core import exceptions as api_exceptions
+
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+# errors of the connection rather than of the request, worth another attempt
+TRANSPORT_ERRORS = (socket.error, ssl.SSLError, httplib.HTTPException, httplib2.HttpLib2Error)
+
+
+class CircuitBreaker(object):
+    """
+    pauses every thread sharing it while a project-wide quota is exhausted, so that they don't keep spending requests
+    that can only fail
+    """
+
+    def __init__(self):
+        self._open_until = 0
+        self._lock = Lock()
+
+    def trip(self, seconds):
+        """
+        open the breaker for seconds, or longer if it is already open longer
+        """
+        with self._lock:
+            self._open_until = max(self._open_until, time.time() + seconds)
+
+    def wait(self):
+        """
+        sleep until the breaker closes; returns right away when it is closed
+        """
+        while True:
+            with self._lock:
+                remaining = self._open_until - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+
+class RetryBudget(object):
+    """
+    retries allowed to one category of a run, so that a bad night can't multiply the run's requests
+    """
+
+    def __init__(self, retries):
+        self.remaining = retries
+        self._lock = Lock()
+
+    def spend(self):
+        """
+        :return: whether a retry was left and has been taken
+        """
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+class RetryPolicy(object):
+    """
+    decides whether and when a failed call is retried: exponential backoff with full jitter, or the server's
+    Retry-After, for transport errors and 408, 429 and 5xx, see is_retryable. A 429 for a project quota trips the
+    shared breaker
+    """
+
+    def __init__(self, max_attempts=3, base_delay=1.0, max_delay=60.0, breaker=None, budgets=None, quota_pause=60):
+        """
+        :param max_attempts: calls of one operation at most, the first one included
+        :param base_delay: seconds of the first backoff, doubled by every attempt
+        :param max_delay: seconds of the longest backoff
+        :param breaker: optional CircuitBreaker shared by the threads of the run
+        :param budgets: optional dict of category to RetryBudget; a category without one is not limited
+        :param quota_pause: seconds the breaker pauses every thread after a project quota error without Retry-After
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker
+        self.budgets = budgets or {}
+        self.quota_pause = quota_pause
+
+    def before_attempt(self):
+        """
+        wait while the breaker is open
+        """
+        if self.breaker is not None:
+            self.breaker.wait()
+
+    def next_delay(self, category, attempt, err):
+        """
+        :param category: category of the operation, to spend its retry budget
+        :param attempt: number of the failed attempt, from 0
+        :param err: exception of the failed attempt
+        :return: seconds to wait before retrying, None to give up
+        """
+        retry_after = get_retry_after(err)
+        # the other threads pause even when this operation gives up
+        if is_project_quota_error(err) and self.breaker is not None:
+            self.breaker.trip(retry_after if retry_after is not None else self.quota_pause)
+        if not is_retryable(err) or attempt + 1 >= self.max_attempts:
+            return None
+        budget = self.budgets.get(category)
+        if budget is not None and not budget.spend():
+            return None
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, category, func):
+        """
+        call func until it returns or next_delay gives up
+        :param category: category of the operation, to spend its retry budget
+        :param func: function without arguments
+        :return: return value of func; the exception of its last attempt is raised
+        """
+        attempt = 0
+        while True:
+            self.before_attempt()
+            try:
+                return func()
+            except Exception as err:
+                delay = self.next_delay(category, attempt, err)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+
+def http_status(err):
+    """
+    :return: HTTP status of an error of Google Fitness API or of a Google Cloud client, None for other errors
+    """
+    if isinstance(err, googleapiclient.errors.HttpError):
+        return err.resp.status
+    if isinstance(err, api_exceptions.GoogleAPICallError):
+        return err.code
+    return None
+
+
+def is_retryable(err):
+    """
+    :return: True for transport errors and the HTTP 408, 429 and 5xx errors of Google APIs; False for everything
+    else, e.g. 400, 401, 403 and 404, rejected refresh tokens and programming errors, which fail the same way again
+    """
+    status = http_status(err)
+    if status is not None:
+        return status in (httplib.REQUEST_TIMEOUT, 429) or status >= 500
+    return isinstance(err, TRANSPORT_ERRORS)
+
+
+def is_project_quota_error(err):
+    """
+    :return: whether err is a 429 of a quota of the whole project rather than of a single user
+    """
+    if http_status(err) != 429:
+        return False
+    message = str(err).lower()
+    return 'per user' not in message and 'peruser' not in message
+
+
+def get_retry_after(err):
+    """
+    :return: seconds of the Retry-After header of a Google API error, None if there is none
+    """
+    if not isinstance(err, googleapiclient.errors.HttpError):
+        return None
+    value = err.resp.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(parsed) - time.time())
@@ -30,12 +30,14 @@ USE `fit`;
 
 CREATE TABLE IF NOT EXISTS `activity` (
   `username` varchar(255) NOT NULL,
-  `day` varchar(255) NOT NULL,
+  `day` date NOT NULL,
   `activity_type` int(11) NOT NULL,
   `length_ms` int(11) NOT NULL,
   `n_segments` int(11) NOT NULL,
   `lastUpdated` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-  PRIMARY KEY (`username`,`day`,`activity_type`)
+  PRIMARY KEY (`username`,`day`,`activity_type`),
+  KEY `day_username` (`day`,`username`),
+  KEY `username_lastUpdated` (`username`,`lastUpdated`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 
 -- --------------------------------------------------------
@@ -195,6 +197,25 @@ INSERT INTO `activity_types` (`name`, `id`) VALUES
 
 -- --------------------------------------------------------
 
+--
+-- Table structure for table `daily_totals`
+--
+-- per user and day rollup of `steps` and `activity`, kept up to date by update_google_fit.update_daily_totals.
+-- active_ms leaves out the activity types of backend.BAD_ACTIVITIES; a NULL column has no rows on that day
+--
+
+CREATE TABLE IF NOT EXISTS `daily_totals` (
+  `username` varchar(255) NOT NULL,
+  `day` date NOT NULL,
+  `steps` int(11) DEFAULT NULL,
+  `active_ms` bigint(20) DEFAULT NULL,
+  `lastUpdated` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`username`,`day`),
+  KEY `day_username` (`day`,`username`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+-- --------------------------------------------------------
+
 --
 -- Table structure for table `google_fit`
 --
@@ -207,9 +228,11 @@ CREATE TABLE IF NOT EXISTS `google_fit` (
   `image_url` varchar(255) NOT NULL,
   `email` varchar(255) NOT NULL,
   `refresh_token` varchar(255) NOT NULL,
+  `synced_day` date DEFAULT NULL,
   `updated_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
   PRIMARY KEY (`google_id`),
-  KEY `google_id` (`google_id`)
+  KEY `google_id` (`google_id`),
+  KEY `username` (`username`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 
 -- --------------------------------------------------------
@@ -220,12 +243,85 @@ CREATE TABLE IF NOT EXISTS `google_fit` (
 
 CREATE TABLE IF NOT EXISTS `steps` (
   `username` varchar(255) NOT NULL,
-  `day` varchar(255) NOT NULL,
+  `day` date NOT NULL,
   `steps` int(11) NOT NULL,
   `lastUpdated` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-  PRIMARY KEY (`username`,`day`)
+  PRIMARY KEY (`username`,`day`),
+  KEY `day_username` (`day`,`username`),
+  KEY `username_lastUpdated` (`username`,`lastUpdated`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `user_groups`
+--
+
+CREATE TABLE IF NOT EXISTS `user_groups` (
+  `group_name` varchar(255) NOT NULL,
+  `username` varchar(255) NOT NULL,
+  `lastModified` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`group_name`,`username`),
+  KEY `username` (`username`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `jobs`
+--
+
+CREATE TABLE IF NOT EXISTS `jobs` (
+  `id` varchar(32) NOT NULL,
+  `kind` varchar(255) NOT NULL,
+  `username` varchar(255) NOT NULL,
+  `status` varchar(16) NOT NULL,
+  `result` text,
+  `error` text,
+  `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `updated_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  KEY `username` (`username`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `schema_migrations`
+--
+-- versions of migrations/ applied by migrate.py; this file already has the schema up to the recorded version
+--
+
+CREATE TABLE IF NOT EXISTS `schema_migrations` (
+  `version` varchar(255) NOT NULL,
+  `name` varchar(255) NOT NULL,
+  `applied_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`version`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+INSERT IGNORE INTO `schema_migrations` (version, name) VALUES
+('0000', 'daily_totals'),
+('0001', 'date_day_columns'),
+('0002', 'last_updated_index'),
+('0003', 'user_groups'),
+('0004', 'synced_day'),
+('0005', 'jobs');
+
+--
+-- Fill `daily_totals` from the rows of `steps` and `activity` stored before the rollup existed
+--
+
+REPLACE INTO `daily_totals` (username, day, steps, active_ms)
+SELECT d.username, d.day,
+  (SELECT s.steps FROM `steps` s WHERE s.username = d.username AND s.day = d.day),
+  (SELECT SUM(a.length_ms) FROM `activity` a INNER JOIN `activity_types` t ON a.activity_type = t.id
+   WHERE a.username = d.username AND a.day = d.day AND a.activity_type NOT IN (0,3,5,109,110,111,112,117,118))
+FROM (
+  SELECT username, day FROM `steps`
+  UNION
+  SELECT username, day FROM `activity`
+) AS d;
+
 /*!40101 SET CHARACTER_SET_CLIENT=@OLD_CHARACTER_SET_CLIENT */;
 /*!40101 SET CHARACTER_SET_RESULTS=@OLD_CHARACTER_SET_RESULTS */;
 /*!40101 SET COLLATION_CONNECTION=@OLD_COLLATION_CONNECTION */;
@@ -1,38 +1,93 @@
 #!/usr/bin/env python
-import json
+import argparse
+import hashlib
+import threading
 from datetime import datetime
 
 import MySQLdb.cursors
 import httplib2
 import pytz
-from googleapiclient.discovery import build
 from oauth2client import client
 
 import backend
+import clients
+import mysql_pool
+from pool import run_in_pool
 
 
-def get_aggregate(fit_service, startTimeMillis, endTimeMillis, dataSourceId):
+def get_aggregate(http_auth, startTimeMillis, endTimeMillis, dataSourceId):
+    return get_aggregates(http_auth, startTimeMillis, endTimeMillis, [dataSourceId])[0]
+
+
+def get_aggregates(http_auth, startTimeMillis, endTimeMillis, dataSourceIds):
+    """
+    aggregate several data sources by day with a single Google Fitness API request
+    :param http_auth: username authenticated HTTP client to call Google API
+    :param startTimeMillis: start time in milliseconds Unix Epoch time
+    :param endTimeMillis: end time in milliseconds Unix Epoch time
+    :param dataSourceIds: list of data source IDs to aggregate
+    :return: list of aggregate responses in the order of dataSourceIds, each shaped as if requested on its own
+    """
+    aggregate = aggregate_request(startTimeMillis, endTimeMillis, dataSourceIds).execute(http=http_auth)
+    return split_aggregate(aggregate, len(dataSourceIds))
+
+
+def aggregate_request(startTimeMillis, endTimeMillis, dataSourceIds):
+    """
+    unexecuted Google Fitness API request aggregating data sources by day, e.g. to add to a batch request
+    :param startTimeMillis: start time in milliseconds Unix Epoch time
+    :param endTimeMillis: end time in milliseconds Unix Epoch time
+    :param dataSourceIds: list of data source IDs to aggregate
+    :return: googleapiclient HttpRequest
+    """
+    fit_service = clients.get_service('fitness', 'v1')
     return fit_service.users().dataset().aggregate(userId="me", body={
         "aggregateBy": [{
             "dataTypeName": "com.google.step_count.delta",
             "dataSourceId": dataSourceId
-        }],
+        } for dataSourceId in dataSourceIds],
         "bucketByTime": {"durationMillis": backend.ONE_DAY_MS},
         "startTimeMillis": startTimeMillis,
         "endTimeMillis": endTimeMillis
-    }).execute()
+    })
+
+
+def split_aggregate(aggregate, n_datasources):
+    """
+    split a multi data source aggregate response into one response per data source;
+    every bucket carries one dataset per entry of aggregateBy, in request order
+    :param aggregate: response of dataset.aggregate
+    :param n_datasources: number of entries in the request's aggregateBy
+    :return: list of aggregate responses with a single dataset per bucket
+    """
+    return [{'bucket': [dict(bucket, dataset=[bucket['dataset'][i]]) for bucket in aggregate.get('bucket', [])]}
+            for i in range(n_datasources)]
 
 
 def get_and_store_fit_data(http_auth, cur, username, past_n_days=30):
-    fit_service = build('fitness', 'v1', http=http_auth)
+    """
+    get a user's daily steps and activity since the last sync, less the RESYNC_DAYS that may still change, and at
+    most past_n_days ago; write the rows whose values changed and the daily_totals of their days
+    :param http_auth: username authenticated HTTP client to call Google API
+    :param cur: MySQL DictCursor
+    :param username: username in google_fit
+    :param past_n_days: days to get at most
+    :return: lists of the [day, steps] and [day, activity_type, length_ms, n_segments] got from Google Fit
+    """
+    today = datetime.now(pytz.timezone(backend.DEFAULT_TIMEZONE)).date()
+    cur.execute("SELECT synced_day FROM google_fit WHERE username=%s", (username,))
+    synced = cur.fetchone()
+    if synced and synced['synced_day']:
+        past_n_days = max(0, min(past_n_days, (today - synced['synced_day']).days + backend.RESYNC_DAYS))
     n_days_ago_millis = backend.calc_n_days_ago(past_n_days)
-    #  print(help(fit_service.users().dataset().aggregate))
     steps = []
     activity = []
     now_millis = backend.current_milli_time()
+    # the watermark moves only when every kind has been got
+    synced_all = True
     print('get and store fitness data for user {}'.format(username))
     try:
-        stepsData = get_aggregate(fit_service, n_days_ago_millis, now_millis, backend.STEPS_DATASOURCE)
+        stepsData = get_aggregate(http_auth, n_days_ago_millis, now_millis, backend.STEPS_DATASOURCE)
         for day in stepsData['bucket']:
             # store local date in the database
             d = datetime.fromtimestamp(int(day['startTimeMillis']) / 1000,
@@ -46,8 +101,9 @@ def get_and_store_fit_data(http_auth, cur, username, past_n_days=30):
     except Exception as e:
         print(e)
         print("No steps found")
+        synced_all = False
     try:
-        activityData = get_aggregate(fit_service, n_days_ago_millis, now_millis, backend.ACTIVITY_DATASOURCE)
+        activityData = get_aggregate(http_auth, n_days_ago_millis, now_millis, backend.ACTIVITY_DATASOURCE)
         for day in activityData['bucket']:
             # store local date in the database
             d = datetime.fromtimestamp(int(day['startTimeMillis']) / 1000,
@@ -64,45 +120,150 @@ def get_and_store_fit_data(http_auth, cur, username, past_n_days=30):
     except Exception as e:
         print(e)
         print("No activity found")
+        synced_all = False
     try:
-        rows = cur.executemany("REPLACE INTO steps SET username=%s, day=%s, steps=%s".format(username),
-                               [[username] + s for s in steps])
-        print("steps: {} rows affected".format(rows))
-        rows = cur.executemany(
-            "REPLACE INTO activity SET username=%s, day=%s, activity_type=%s, length_ms=%s, n_segments=%s",
-            [[username] + a for a in activity])
-        print("activity: {} rows affected".format(rows))
+        changed_steps = changed_rows(cur, 'steps', ['day', 'steps'], username, steps, 1)
+        if changed_steps:
+            rows = cur.executemany(
+                "INSERT INTO steps (username, day, steps) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE steps=VALUES(steps)",
+                [[username] + s for s in changed_steps])
+            print("steps: {} rows affected".format(rows))
+        changed_activity = changed_rows(cur, 'activity', ['day', 'activity_type', 'length_ms', 'n_segments'],
+                                        username, activity, 2)
+        if changed_activity:
+            rows = cur.executemany(
+                "INSERT INTO activity (username, day, activity_type, length_ms, n_segments) VALUES (%s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE length_ms=VALUES(length_ms), n_segments=VALUES(n_segments)",
+                [[username] + a for a in changed_activity])
+            print("activity: {} rows affected".format(rows))
+        rows = update_daily_totals(cur, username,
+                                   set(s[0] for s in changed_steps) | set(a[0] for a in changed_activity))
+        print("daily_totals: {} rows affected".format(rows))
+        if synced_all:
+            cur.execute("UPDATE google_fit SET synced_day=%s WHERE username=%s", (today, username))
     except Exception as e:
         print(e)
     return steps, activity
 
 
-if __name__ == "__main__":
-    with open(backend.client_secret_file) as f:
-        client_secret_json = json.load(f)
-        client_id = client_secret_json['web']['client_id']
-        client_secret = client_secret_json['web']['client_secret']
-
-    db = MySQLdb.connect(host=backend.config.get('database_config', 'dbhost'),
-                         port=int(backend.config.get('database_config', 'dbport')),
-                         user=backend.config.get('database_config', 'dbuser'),
-                         passwd=backend.config.get('database_config', 'dbpass'),
-                         db=backend.config.get('database_config', 'dbname'),
-                         cursorclass=MySQLdb.cursors.DictCursor)
-    cur = db.cursor()
-    n_rows = cur.execute("SELECT * FROM google_fit")
-    rows = cur.fetchall()
-    for r in rows:
-        username = r['username']
-        refresh_token = r['refresh_token']
-        creds = client.GoogleCredentials("", client_id, client_secret, refresh_token, 0,
+def changed_rows(cur, table, columns, username, rows, n_keys):
+    """
+    leave out the rows already stored in a table with the same values
+    :param cur: MySQL DictCursor
+    :param table: steps or activity
+    :param columns: columns of each row, starting with day and the other key columns
+    :param username: username of the rows
+    :param rows: lists of the columns' values from Google Fit
+    :param n_keys: number of key columns, day included
+    :return: the rows that are new or have different values
+    """
+    if not rows:
+        return []
+    cur.execute("SELECT {} FROM {} WHERE username=%s AND day >= %s".format(', '.join(columns), table),
+                (username, min(r[0] for r in rows)))
+    stored = {}
+    for r in cur.fetchall():
+        key = tuple(str(r[c]) for c in columns[:n_keys])
+        stored[key] = [int(r[c]) for c in columns[n_keys:]]
+    return [r for r in rows if stored.get(tuple(str(v) for v in r[:n_keys])) != [int(v) for v in r[n_keys:]]]
+
+
+def update_daily_totals(cur, username, days):
+    """
+    recompute the daily_totals rollup of a user's days from the steps and activity tables
+    :param cur: MySQL cursor
+    :param username: username of the rows
+    :param days: local dates in DATE_FORMAT whose steps or activity rows have been written
+    :return: number of affected rows
+    """
+    if not days:
+        return 0
+    days = sorted(days)
+    in_days = ', '.join(['%s'] * len(days))
+    return cur.execute(
+        """REPLACE INTO daily_totals (username, day, steps, active_ms)
+SELECT d.username, d.day,
+  (SELECT s.steps FROM steps s WHERE s.username = d.username AND s.day = d.day),
+  (SELECT SUM(a.length_ms) FROM activity a INNER JOIN activity_types t ON a.activity_type = t.id
+   WHERE a.username = d.username AND a.day = d.day AND a.activity_type NOT IN {bad})
+FROM (
+  SELECT username, day FROM steps WHERE username = %s AND day IN ({days})
+  UNION
+  SELECT username, day FROM activity WHERE username = %s AND day IN ({days})
+) AS d""".format(bad=backend.BAD_ACTIVITIES, days=in_days),
+        [username] + days + [username] + days)
+
+
+def in_shard(username, shard, n_shards):
+    """
+    :return: whether the user belongs to shard i of n, by the MD5 hash of the username
+    """
+    return int(hashlib.md5(username.encode('utf-8')).hexdigest(), 16) % n_shards == shard
+
+
+def update_users(rows, workers=8, commit_every=20, past_n_days=30):
+    """
+    get and store the fitness data of users on a pool of threads, each with its own database connection
+    :param rows: google_fit rows with username and refresh_token
+    :param workers: number of threads
+    :param commit_every: users stored by a thread between its commits
+    :param past_n_days: days of data to get for each user
+    :return: list of (row, exception) of the users that failed
+    """
+    client_id, client_secret = backend.load_client_secret()
+    local = threading.local()
+
+    def open_connection():
+        local.db = mysql_pool.connect(cursorclass=MySQLdb.cursors.DictCursor)
+        local.cur = local.db.cursor()
+        local.uncommitted = 0
+
+    def close_connection():
+        try:
+            local.db.commit()
+            local.cur.close()
+        finally:
+            # disconnect from server
+            local.db.close()
+
+    def update_user(r):
+        creds = client.GoogleCredentials("", client_id, client_secret, r['refresh_token'], 0,
                                          "https://accounts.google.com/o/oauth2/token", "Python")
         http_auth = creds.authorize(httplib2.Http())
         try:
-            steps, activity = get_and_store_fit_data(http_auth, cur, username)
+            get_and_store_fit_data(http_auth, local.cur, r['username'], past_n_days)
         except Exception as e:
-            print("Unable to get fit data for {}! {}".format(username, e))
-        db.commit()
+            print("Unable to get fit data for {}! {}".format(r['username'], e))
+            raise
+        finally:
+            local.uncommitted += 1
+            if local.uncommitted >= commit_every:
+                local.db.commit()
+                local.uncommitted = 0
+
+    return run_in_pool(update_user, rows, workers, initializer=open_connection, finalizer=close_connection)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='get and store the Google Fit data of the users in google_fit')
+    parser.add_argument('--workers', type=int, default=8, help='threads, each with its own database connection')
+    parser.add_argument('--shard', default='0/1',
+                        help='i/n: update the users of shard i of n by username hash, to split users between machines')
+    parser.add_argument('--commit-every', type=int, default=20, help='users stored by a thread between commits')
+    parser.add_argument('--past-n-days', type=int, default=30, help='days of data to get for each user')
+    args = parser.parse_args()
+    try:
+        shard, n_shards = [int(v) for v in args.shard.split('/')]
+        if not 0 <= shard < n_shards:
+            raise ValueError
+    except ValueError:
+        parser.error('--shard must be i/n with 0 <= i < n')
+
+    db = mysql_pool.connect(cursorclass=MySQLdb.cursors.DictCursor)
+    cur = db.cursor()
+    cur.execute("SELECT username, refresh_token FROM google_fit")
+    rows = [r for r in cur.fetchall() if in_shard(r['username'], shard, n_shards)]
     cur.close()
-    # disconnect from server
     db.close()
+    print('updating {} users of shard {}/{}'.format(len(rows), shard, n_shards))
+    failures = update_users(rows, args.workers, args.commit_every, args.past_n_days)
+    print('{} users failed'.format(len(failures)))